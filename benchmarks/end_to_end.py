@@ -0,0 +1,387 @@
+import io
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import http_client
+import http_replay
+import itime
+import jira_issue_cache
+import jira_sync
+import tempo_accounts
+import toggl
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ['sync', 'itime']
+SIZES = [10, 100, 1000, 10000]
+
+# stand-in servers answer after this many seconds, roughly the round trip to the real services
+DEFAULT_LATENCY = 0.02
+
+ISSUE_COUNT = 50
+ACCOUNT_COUNT = 10
+MIN_WEEKS = 4
+ENTRIES_PER_DAY = 300  # 4 minute entries, all of them fit into a single day
+ENTRY_MINUTES = 4
+
+RESULT_FILE = 'benchmark-result.json'
+
+BENCHMARK_ENV = {
+    'toggl_api_token': 'benchmark',
+    'tempo_api_token': 'benchmark',
+    'jira_api_token': 'benchmark',
+    'jira_user_email': 'benchmark@example.com',
+    'jira_user_id': 'benchmark-user',
+    'itime_username': 'benchmark',
+    'itime_password_base_64': 'YmVuY2htYXJr',
+    'http_record_path': '',
+}
+
+
+def get_weeks(entry_count: int) -> list[date]:
+    # whole weeks which are already over, so every week can be submitted to itime
+    week_count = max(MIN_WEEKS, math.ceil(entry_count / ENTRIES_PER_DAY / 7))
+    today = date.today()
+    last_week_start = today - timedelta(days=today.weekday() + 7)
+
+    return [last_week_start - timedelta(weeks=week) for week in reversed(range(week_count))]
+
+
+def get_issue(number: int) -> dict:
+    # the account field carries the tempo account id, see the accounts directory in itime_cassette
+    account_id = number % ACCOUNT_COUNT
+    account_number = 10000000 + account_id
+
+    return {
+        'id': str(10000 + number),
+        'key': 'BENCH-%d' % number,
+        'self': http_client.JIRA_URL + 'rest/api/2/issue/%d' % (10000 + number),
+        'fields': {
+            'project': {'key': 'BENCH'},
+            jira_issue_cache.ACCOUNT_FIELD: {'id': account_id, 'value': 'Account %d' % account_number},
+        },
+    }
+
+
+def json_exchange(method: str, url: str, body, request_body=None, status: int = 200) -> dict:
+    return {
+        'method': method,
+        'url': url,
+        'request_body': json.dumps(request_body) if request_body is not None else None,
+        'status': status,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(body),
+    }
+
+
+def html_exchange(method: str, url: str, body: str) -> dict:
+    return {
+        'method': method,
+        'url': url,
+        'request_body': None,
+        'status': 200,
+        'headers': {'Content-Type': 'text/html'},
+        'body': body,
+    }
+
+
+def jira_exchanges(lookup: str) -> list[dict]:
+    exchanges = []
+
+    for number in range(1, ISSUE_COUNT + 1):
+        issue = get_issue(number)
+        # sync looks issues up by their key, itime by the id tempo reports
+        exchanges.append(json_exchange('GET', http_client.JIRA_URL + 'rest/api/2/issue/' + issue[lookup], issue))
+
+    return exchanges
+
+
+def sync_cassette(entry_count: int) -> tuple[list[dict], str, str]:
+    weeks = get_weeks(entry_count)
+    days = len(weeks) * 7
+    start_date = weeks[0].strftime(toggl.TOGGL_DATE_FORMAT)
+    end_date = (weeks[-1] + timedelta(days=7)).strftime(toggl.TOGGL_DATE_FORMAT)
+
+    entries = []
+    for index in range(entry_count):
+        day = datetime.combine(weeks[0] + timedelta(days=index % days), datetime.min.time(), timezone.utc)
+        start = day + timedelta(minutes=ENTRY_MINUTES * (index // days))
+
+        entries.append({
+            'id': index + 1,
+            'description': 'BENCH-%d benchmark entry %d' % (index % ISSUE_COUNT + 1, index),
+            'start': start.isoformat(),
+            'stop': (start + timedelta(minutes=ENTRY_MINUTES)).isoformat(),
+        })
+
+    exchanges = []
+    for window_start, window_end in toggl.split_date_range(start_date, end_date):
+        window_entries = [
+            entry for entry in entries
+            if window_start <= entry['start'][:10] < window_end
+        ]
+        exchanges.append(json_exchange(
+            'GET',
+            toggl.toggl_time_entries_url + '?start_date=%s&end_date=%s' % (window_start, window_end),
+            window_entries
+        ))
+
+    exchanges += jira_exchanges('key')
+    exchanges.append(json_exchange(
+        'GET',
+        jira_sync.tempo_api_url + '/work-attributes?key=' + jira_sync.WORKLOG_ATTRIBUTE_KEY,
+        {'results': [{'key': jira_sync.WORKLOG_ATTRIBUTE_KEY}]}
+    ))
+    exchanges.append(json_exchange('POST', jira_sync.tempo_api_url + '/worklogs', {'tempoWorklogId': 1}))
+
+    return exchanges, start_date, end_date
+
+
+def itime_cassette(entry_count: int) -> tuple[list[dict], int]:
+    weeks = get_weeks(entry_count)
+    days = len(weeks) * 7
+
+    worklogs = {week_start: [] for week_start in weeks}
+    for index in range(entry_count):
+        day = weeks[0] + timedelta(days=index % days)
+        worklogs[weeks[(day - weeks[0]).days // 7]].append({
+            'issue': {'id': 10000 + index % ISSUE_COUNT + 1},
+            'startDate': day.strftime(itime.TEMPO_DATE_FORMAT),
+            'timeSpentSeconds': 900,
+        })
+
+    search_url = itime.tempo_api_url + '/worklogs/search'
+    exchanges = []
+
+    for week_start, week_worklogs in worklogs.items():
+        search = {
+            'authorIds': [BENCHMARK_ENV['jira_user_id']],
+            'from': week_start.strftime(itime.TEMPO_DATE_FORMAT),
+            'to': (week_start + timedelta(days=6)).strftime(itime.TEMPO_DATE_FORMAT),
+        }
+
+        limit = itime.TEMPO_SEARCH_PAGE_LIMIT
+        for offset in range(0, max(len(week_worklogs), 1), limit):
+            has_next = offset + limit < len(week_worklogs)
+            exchanges.append(json_exchange('POST', search_url + '?offset=%d&limit=%d' % (offset, limit), {
+                'results': week_worklogs[offset:offset + limit],
+                'metadata': {
+                    'next': search_url + '?offset=%d&limit=%d' % (offset + limit, limit) if has_next else None,
+                },
+            }, search))
+
+    exchanges += jira_exchanges('id')
+
+    # issue ids are resolved by searches, the stand-in answers every chunk with all issues
+    exchanges.append(json_exchange('POST', http_client.JIRA_URL + 'rest/api/2/search/jql', {
+        'issues': [get_issue(number) for number in range(1, ISSUE_COUNT + 1)],
+        'isLast': True,
+    }))
+
+    exchanges.append(json_exchange('GET', itime.tempo_api_url + '/accounts?offset=0&limit=%d' % tempo_accounts.PAGE_LIMIT, {
+        'results': [
+            {'id': number, 'key': 'P%d' % (10000000 + number), 'name': 'Account %d' % (10000000 + number), 'status': 'OPEN'}
+            for number in range(ACCOUNT_COUNT)
+        ],
+        'metadata': {'next': None},
+    }))
+
+    sheets = [
+        '%s^%d' % ((week_start + timedelta(days=6)).strftime(itime.ITIME_JSON_DATE_FORMAT), 900000 + index)
+        for index, week_start in enumerate(weeks)
+    ]
+    exchanges.append(json_exchange('POST', itime.itime_base_url + itime.itime_existing_sheets_url, {
+        'Created_not_submitted': sheets,
+        'Missing_late': [],
+        'future_notcreated': [],
+    }))
+
+    options = ''.join(
+        '<option value="%d">Account %d</option>' % (10000000 + number, 10000000 + number)
+        for number in range(ACCOUNT_COUNT)
+    )
+    exchanges.append(html_exchange(
+        'GET',
+        itime.itime_base_url + itime.itime_projects_url + '?TimeCard_ID=0',
+        '<html><body><form><select id="%s" name="%s">%s</select></form></body></html>' % (
+            itime.PERSONAL_PROJECTS_LIST_ID, itime.PERSONAL_PROJECTS_LIST_ID, options
+        )
+    ))
+
+    exchanges.append(html_exchange('GET', itime.itime_base_url + itime.itime_home_url, '<html><body></body></html>'))
+    exchanges.append(html_exchange(
+        'GET',
+        itime.itime_base_url + itime.itime_timesheet_detail_url,
+        '<html><body><form><input type="hidden" name="TimeCard_ID" value="0">'
+        '<input type="hidden" name="TimeCardRowCount" value="0"></form></body></html>'
+    ))
+
+    # weeks are saved and submitted in order, both are answered with the saved timecard of the week
+    for week_start, week_worklogs in worklogs.items():
+        timecard = get_saved_timecard(week_start, week_worklogs)
+
+        for _ in range(1 if itime.ITIME_SUBMIT_WITHOUT_SAVE else 2):
+            exchanges.append(html_exchange('POST', itime.itime_base_url + itime.itime_timesheet_save_url, timecard))
+
+    return exchanges, len(weeks)
+
+
+def get_saved_timecard(week_start: date, week_worklogs: list[dict]) -> str:
+    with io.open(os.path.join(PROJECT_DIR, 'jira_itime_task_mapping.json'), 'r') as f:
+        task = json.load(f)['default']
+
+    rows = {}
+
+    for worklog in week_worklogs:
+        project_id = str(10000000 + (worklog['issue']['id'] - 10000) % ACCOUNT_COUNT)
+        day_index = (datetime.strptime(worklog['startDate'], itime.TEMPO_DATE_FORMAT).date() - week_start).days
+        rows.setdefault(project_id, [0] * 7)[day_index] += worklog['timeSpentSeconds']
+
+    fields = [('TimeCardRowCount', str(len(rows)))]
+    for row_index, (project_id, day_seconds) in enumerate(rows.items(), 1):
+        fields += [('r%d_Projname' % row_index, project_id), ('r%d_Taskname' % row_index, task)]
+        fields += [
+            ('r%d_%s' % (row_index, day), itime.format_seconds_for_itime(seconds))
+            for day, seconds in zip(itime.WEEK_DAYS, day_seconds)
+        ]
+
+    return '<html><body><form>%s</form></body></html>' % ''.join(
+        '<input type="hidden" name="%s" value="%s">' % field for field in fields
+    )
+
+
+def run_scenario(scenario: str, args: list[str]) -> dict:
+    # runs in a fresh process inside an empty working directory, caches and the ledger start cold
+    latencies = []
+    http_client.add_response_listener(lambda exchange: latencies.append(exchange['elapsed']))
+
+    started = time.perf_counter()
+
+    if scenario == 'sync':
+        import asyncio
+        import sync_pipeline
+
+        jira_sync.create_worklog_attribute()
+        results = asyncio.run(sync_pipeline.sync_period(args[0], args[1]))
+        processed = len([result for result in results if result['status'] == 'posted'])
+    else:
+        itime.itime_login()
+        itime.load_jira_account_itime_mapping()
+        itime.check_jira_itime_task_mapping()
+        processed = itime.process_catch_up(int(args[0]), confirm=False)
+
+    return {
+        'seconds': time.perf_counter() - started,
+        'processed': processed,
+        'latencies': latencies,
+    }
+
+
+def run_benchmark(scenario: str, entry_count: int, latency: float, rate_limit: float) -> dict:
+    if scenario == 'sync':
+        exchanges, start_date, end_date = sync_cassette(entry_count)
+        args = [start_date, end_date]
+    else:
+        exchanges, week_count = itime_cassette(entry_count)
+        args = [str(week_count)]
+
+    servers = http_replay.serve(http_replay.Cassette(exchanges), latency, rate_limit=rate_limit)
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+
+    try:
+        shutil.copy(os.path.join(PROJECT_DIR, 'jira_itime_task_mapping.json'), directory)
+        with io.open(os.path.join(directory, 'itime_cookies.txt'), 'w') as f:
+            f.write('CFID=benchmark; CFTOKEN=benchmark')
+
+        env = {
+            **os.environ,
+            **BENCHMARK_ENV,
+            **http_replay.get_service_settings(servers),
+            # dependencies may come from the caller's PYTHONPATH, the project is added after them
+            'PYTHONPATH': os.pathsep.join(filter(None, [os.environ.get('PYTHONPATH'), PROJECT_DIR])),
+        }
+
+        subprocess.run(
+            [sys.executable, '-m', 'benchmarks.end_to_end', '--run', scenario, *args],
+            cwd=directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            check=True
+        )
+
+        with io.open(os.path.join(directory, RESULT_FILE), 'r') as f:
+            result = json.load(f)
+    finally:
+        for server in servers.values():
+            server.stop()
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    result['entries'] = entry_count
+    result['expected'] = entry_count if scenario == 'sync' else week_count
+
+    return result
+
+
+def format_percentiles(latencies: list[float]) -> str:
+    if len(latencies) < 2:
+        return '%8s %8s %8s' % ('-', '-', '-')
+
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+
+    return '%6.1f ms %5.1f ms %5.1f ms' % (percentiles[49] * 1000, percentiles[89] * 1000, percentiles[98] * 1000)
+
+
+def print_usage():
+    print('Usage: python -m benchmarks.end_to_end [sync|itime ...] [entries ...] [--latency=MS] [--rate=REQUESTS_PER_SECOND]')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        with io.open(RESULT_FILE, 'w') as f:
+            json.dump(run_scenario(sys.argv[2], sys.argv[3:]), f)
+
+        exit(0)
+
+    scenarios = [arg for arg in sys.argv[1:] if arg in SCENARIOS] or SCENARIOS
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()] or SIZES
+    latency = DEFAULT_LATENCY
+    rate_limit = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith('--latency='):
+            latency = float(arg.split('=', 1)[1]) / 1000
+        elif arg.startswith('--rate='):
+            rate_limit = float(arg.split('=', 1)[1])
+        elif arg not in SCENARIOS and not arg.isdigit():
+            print_usage()
+            exit(1)
+
+    print('Stand-in latency %.0f ms, rate limit %s' % (latency * 1000, '%g/s' % rate_limit if rate_limit else 'none'))
+    print('%-8s %8s %9s %11s %9s %8s %8s %8s' % ('scenario', 'entries', 'wall', 'entries/s', 'requests', 'p50', 'p90', 'p99'))
+
+    for scenario in scenarios:
+        for size in sizes:
+            result = run_benchmark(scenario, size, latency, rate_limit)
+
+            if result['processed'] != result['expected']:
+                print('%s with %d entries processed %d of %d items, the stand-in cassette is incomplete' % (
+                    scenario, size, result['processed'], result['expected']
+                ))
+
+            print('%-8s %8d %7.2f s %11.1f %9d %s' % (
+                scenario,
+                result['entries'],
+                result['seconds'],
+                result['entries'] / result['seconds'],
+                len(result['latencies']),
+                format_percentiles(result['latencies'])
+            ))
@@ -0,0 +1,131 @@
+import glob
+import io
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+import itime_forms
+
+# saved iTime pages, e.g. TmCrdEntry.CFM and Emp_PrjctAcsForm.cfm responses saved from the browser
+FIXTURES_DIR = 'debug/fixtures/itime'
+OPTION_LIST_IDS = ['EmplyPrjct_Lst', 'Prjct_Lst']
+ROUNDS = 20
+
+WEEK_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def html5lib_form_fields(html: str) -> dict[str, str]:
+    soup = BeautifulSoup(html, 'html5lib')
+
+    form_data = {}
+    inputs = soup.select('form input, form select, form textarea')
+
+    for input_element in inputs:
+        if 'name' not in input_element.attrs:
+            continue
+
+        input_value = ''
+        if input_element.name == 'input' or input_element.name == 'textarea':
+            if 'value' in input_element.attrs:
+                input_value = input_element.attrs['value']
+        elif input_element.name == 'select':
+            selected = input_element.select_one('option[selected]')
+
+            if selected is None:
+                selected = input_element.select_one('option:first-child')
+
+            if selected is not None and 'value' in selected.attrs:
+                input_value = selected.attrs['value']
+
+        form_data[input_element.attrs['name']] = input_value
+
+    return form_data
+
+
+def html5lib_options(html: str, element_id: str) -> list[tuple[str, str]]:
+    soup = BeautifulSoup(html, 'html5lib')
+
+    return [(tag.attrs.get('value', ''), tag.text) for tag in soup.select('#' + element_id + ' option')]
+
+
+def create_timecard_page(rows: int = 40, projects: int = 300) -> str:
+    project_options = ''.join(
+        '<option value="P%09d">P%09d - Project %d' % (i, i, i) for i in range(projects)
+    )
+
+    html = ['<html><head><title>Time Card Entry</title></head><body>']
+    html.append('<select id="EmplyPrjct_Lst" name="EmplyPrjct_Lst" multiple>%s</select>' % project_options)
+    html.append('<form name="TmCrdEntry" method="post" action="timecard_proc_v2.cfm"><table>')
+    html.append('<input type="hidden" name="TimeCard_ID" value="123456">')
+
+    for row in range(1, rows + 1):
+        html.append('<tr>')
+        html.append('<td><select name="r%d_Projname"><option value="">Select'
+                    '<option value="P%09d" selected>P%09d%s</select></td>' % (row, row, row, project_options))
+        html.append('<td><input type="text" name="r%d_Taskname" value="C0001"></td>' % row)
+        html.append('<td><textarea name="r%d_Comment"></textarea></td>' % row)
+
+        for day in WEEK_DAYS:
+            html.append('<td><input type="text" name="r%d_%s" value="0" size="4"></td>' % (row, day))
+
+        html.append('<td><input type="text" name="tot2%d" value="0.00" readonly></td></tr>' % row)
+
+    html.append('</table><input type="submit" name="Submit" value="Submit"></form></body></html>')
+
+    return ''.join(html)
+
+
+def load_fixtures() -> dict[str, str]:
+    fixtures = {}
+
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.html'))):
+        with io.open(path, 'r', encoding='utf-8', errors='replace') as f:
+            fixtures[os.path.basename(path)] = f.read()
+
+    if not fixtures:
+        print('No fixtures found in %s, using a synthetic timecard page' % FIXTURES_DIR)
+        fixtures['synthetic-timecard.html'] = create_timecard_page()
+
+    return fixtures
+
+
+def measure(function, *args) -> float:
+    started = time.perf_counter()
+
+    for _ in range(ROUNDS):
+        function(*args)
+
+    return (time.perf_counter() - started) / ROUNDS * 1000
+
+
+def benchmark(name: str, html: str):
+    cases = [('form fields', html5lib_form_fields, itime_forms.extract_form_fields, ())]
+
+    for element_id in OPTION_LIST_IDS:
+        if 'id="%s"' % element_id in html:
+            cases.append(('#' + element_id, html5lib_options, itime_forms.extract_options, (element_id,)))
+
+    for case, current, extractor, args in cases:
+        if current(html, *args) != extractor(html, *args):
+            print('%-30s %-20s results differ' % (name, case))
+            continue
+
+        current_ms = measure(current, html, *args)
+        extractor_ms = measure(extractor, html, *args)
+
+        print('%-30s %-20s %10.2f ms %10.2f ms %8.1fx' % (name, case, current_ms, extractor_ms, current_ms / extractor_ms))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        FIXTURES_DIR = sys.argv[1]
+
+    fixtures = load_fixtures()
+
+    print('%-30s %-20s %13s %13s %9s' % ('fixture', 'extracted', 'html5lib', 'itime_forms', 'speedup'))
+
+    for fixture_name, fixture_html in fixtures.items():
+        print('%-30s %d kB' % (fixture_name, len(fixture_html) // 1024))
+        benchmark(fixture_name, fixture_html)
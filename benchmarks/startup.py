@@ -0,0 +1,34 @@
+import statistics
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = ['itime', 'sync', 'toggl', 'jira_sync', 'jira_account_update', 'team']
+ROUNDS = 10
+
+
+def measure_import(module: str) -> list[float]:
+    # every import runs in a fresh interpreter, nothing is cached between rounds except the bytecode
+    timings = []
+
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + module if module else 'pass'], check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return timings
+
+
+if __name__ == '__main__':
+    entry_points = sys.argv[1:] or ENTRY_POINTS
+
+    baseline = statistics.median(measure_import(''))
+
+    print('%-22s %10s %10s %12s' % ('entry point', 'median', 'min', 'over python'))
+    print('%-22s %7.1f ms %7.1f ms %9s' % ('(python)', baseline, baseline, '-'))
+
+    for entry_point in entry_points:
+        timings = measure_import(entry_point)
+        median = statistics.median(timings)
+
+        print('%-22s %7.1f ms %7.1f ms %9.1f ms' % (entry_point, median, min(timings), median - baseline))
@@ -0,0 +1,8 @@
+import os
+
+DEBUG_DIRECTORY = 'debug'
+
+
+def create_debug_directory():
+    if not os.path.exists(DEBUG_DIRECTORY):
+        os.makedirs(DEBUG_DIRECTORY)
@@ -0,0 +1,266 @@
+import os
+import threading
+import time
+from base64 import b64encode
+from functools import partial
+
+from dotenv import load_dotenv
+
+try:
+    import brotli  # noqa: F401 - urllib3 decodes br responses only when brotli is installed
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+load_dotenv()
+
+# requests, aiohttp, jira and requests_ntlm are imported on first use, so entry points start without loading them
+
+# services can be pointed at local stand-in servers, see http_replay.py
+JIRA_URL = os.getenv('jira_url', 'https://ipsos-cx.atlassian.net/')
+TEMPO_API_URL = os.getenv('tempo_api_url', 'https://api.tempo.io/4')
+TOGGL_API_URL = os.getenv('toggl_api_url', 'https://api.track.toggl.com/api/v9')
+TOGGL_REPORTS_URL = os.getenv('toggl_reports_url', 'https://api.track.toggl.com/reports/api/v3')
+ITIME_URL = os.getenv('itime_base_url', 'https://itime.ipsos.com/')
+
+SERVICE_URLS = {
+    'jira_url': JIRA_URL,
+    'tempo_api_url': TEMPO_API_URL,
+    'toggl_api_url': TOGGL_API_URL,
+    'toggl_reports_url': TOGGL_REPORTS_URL,
+    'itime_base_url': ITIME_URL,
+}
+
+# every exchange of every client is appended to this cassette when set
+HTTP_RECORD_PATH = os.getenv('http_record_path')
+
+# exports are read as a stream by their callers, listeners get them without a body, so they aren't replayable
+STREAMED_CONTENT_TYPES = ('text/csv',)
+
+CONNECT_TIMEOUT = float(os.getenv('http_connect_timeout', '10'))
+READ_TIMEOUT = float(os.getenv('http_read_timeout', '60'))
+
+# sized for the largest thread pool used against a single host
+POOL_SIZE = int(os.getenv('http_pool_size', '16'))
+
+_sessions = {}
+_jira_clients = {}
+_lock = threading.Lock()
+
+_response_listeners = []
+_recording = False
+
+
+def add_response_listener(listener):
+    # listeners are called with an exchange dict for every response received by any client, redirects included
+    _response_listeners.append(listener)
+
+
+def remove_response_listener(listener):
+    _response_listeners.remove(listener)
+
+
+def notify_response(exchange: dict):
+    for listener in _response_listeners:
+        listener(exchange)
+
+
+def start_recording():
+    global _recording
+
+    if HTTP_RECORD_PATH and not _recording:
+        import http_replay
+
+        _recording = True
+        add_response_listener(http_replay.CassetteRecorder(HTTP_RECORD_PATH))
+
+
+def observe_session(session):
+    def on_response(response, *args, **kwargs):
+        if not _response_listeners:
+            return
+
+        body = response.request.body
+        streamed = response.headers.get('Content-Type', '').startswith(STREAMED_CONTENT_TYPES)
+
+        notify_response({
+            'method': response.request.method,
+            'url': response.request.url,
+            'request_body': body.decode('utf-8', 'replace') if isinstance(body, bytes) else body,
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'body': None if streamed else response.content,
+            'elapsed': response.elapsed.total_seconds(),
+        })
+
+    start_recording()
+    session.hooks['response'].append(on_response)
+
+
+def create_trace_config():
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+        context.chunks = []
+
+    async def on_request_chunk_sent(session, context, params):
+        context.chunks.append(params.chunk)
+
+    async def on_request_end(session, context, params):
+        if not _response_listeners:
+            return
+
+        # the body is cached on the response, reading it here does not consume it for the caller
+        elapsed = time.perf_counter() - context.started
+        body = await params.response.read()
+
+        notify_response({
+            'method': params.method,
+            'url': str(params.url),
+            'request_body': b''.join(context.chunks).decode('utf-8', 'replace') if context.chunks else None,
+            'status': params.response.status,
+            'headers': dict(params.response.headers),
+            'body': body,
+            'elapsed': elapsed,
+        })
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace_config.on_request_end.append(on_request_end)
+
+    return trace_config
+
+
+def create_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+    # a timeout passed by the caller still takes precedence
+    session.request = partial(session.request, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    observe_session(session)
+
+    return session
+
+
+def get_session(name: str, configure=None, credentials: tuple = ()):
+    # sessions are created once per service and reused, so connections and auth handshakes are kept alive,
+    # they are kept per credentials, so a process running for several users never mixes their sessions up
+    key = (name, *credentials)
+
+    with _lock:
+        if key not in _sessions:
+            session = create_session()
+
+            if configure is not None:
+                configure(session)
+
+            _sessions[key] = session
+
+        return _sessions[key]
+
+
+def get_tempo_session():
+    api_token = os.getenv('tempo_api_token')
+
+    def configure(session):
+        session.headers.update({
+            'Authorization': f'Bearer {api_token}',
+            'Accept': 'application/json',
+        })
+
+    return get_session('tempo', configure, (api_token,))
+
+
+def get_toggl_session():
+    api_token = os.getenv('toggl_api_token')
+
+    def configure(session):
+        session.headers.update({
+            'content-type': 'application/json',
+            'Authorization': 'Basic %s' % b64encode(f"{api_token}:api_token".encode('ascii')).decode("ascii")
+        })
+
+    return get_session('toggl', configure, (api_token,))
+
+
+def get_itime_session(username: str, password: str):
+    def configure(session):
+        from requests_ntlm import HttpNtlmAuth
+
+        # NTLM authenticates a connection, not a request, so a kept alive connection skips the handshake
+        session.auth = HttpNtlmAuth(username, password)
+        session.headers.update({
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+            'Accept-Language': 'en-GB,en;q=0.9',
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36',
+        })
+
+    return get_session('itime', configure, (username, password))
+
+
+def get_jira_session():
+    credentials = (os.getenv('jira_user_email'), os.getenv('jira_api_token'))
+
+    # a plain session for requests the jira client has no public method for, it never retries on its own
+    def configure(session):
+        session.auth = credentials
+        session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+
+    return get_session('jira', configure, credentials)
+
+
+def get_jira_client():
+    credentials = (os.getenv('jira_user_email'), os.getenv('jira_api_token'))
+
+    # only issues are read with the client, none of its calls used here depend on the server version,
+    # so server info is never fetched and the client costs no request until it is used
+    with _lock:
+        if credentials not in _jira_clients:
+            from jira import JIRA
+            from requests.adapters import HTTPAdapter
+
+            jira = JIRA(
+                JIRA_URL,
+                options={'headers': {'Accept-Encoding': ACCEPT_ENCODING}},
+                basic_auth=credentials,
+                timeout=READ_TIMEOUT,
+                get_server_info=False
+            )
+
+            # the client can't be given a session, its own one gets the pooled adapter and is observed
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            jira._session.mount('https://', adapter)
+            jira._session.mount('http://', adapter)
+            observe_session(jira._session)
+
+            _jira_clients[credentials] = jira
+
+        return _jira_clients[credentials]
+
+
+def create_async_tempo_session(limit: int):
+    import aiohttp
+
+    start_recording()
+
+    return aiohttp.ClientSession(
+        headers={
+            'Authorization': f'Bearer {os.getenv("tempo_api_token")}',
+            'Accept': 'application/json',
+        },
+        connector=aiohttp.TCPConnector(limit_per_host=limit, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+        trace_configs=[create_trace_config()]
+    )
@@ -0,0 +1,271 @@
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import http_client
+
+# only headers needed to replay a response are kept, cookies and credentials never end up in a cassette
+RECORDED_HEADERS = {'content-type', 'location', 'retry-after'}
+
+
+def get_origin(url: str) -> str:
+    parts = urlsplit(url)
+
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    # clients differ in whether they send doubled slashes, e.g. the itime base url joined with an absolute path
+    return re.sub('/{2,}', '/', parts.path) + ('?' + query if query else '')
+
+
+def normalize_body(body: Optional[str]) -> Optional[str]:
+    if not body:
+        return None
+
+    try:
+        return json.dumps(json.loads(body), sort_keys=True)
+    except ValueError:
+        # form posts are compared regardless of the order of their fields
+        return urlencode(sorted(parse_qsl(body, keep_blank_values=True)))
+
+
+def to_record(exchange: dict) -> dict:
+    body = exchange['body']
+
+    return {
+        'method': exchange['method'],
+        'url': exchange['url'],
+        'request_body': exchange['request_body'],
+        'status': exchange['status'],
+        'headers': {name: value for name, value in exchange['headers'].items() if name.lower() in RECORDED_HEADERS},
+        'body': body.decode('utf-8', 'replace') if isinstance(body, bytes) else body or '',
+    }
+
+
+class CassetteRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def __call__(self, exchange: dict):
+        line = json.dumps(to_record(exchange), ensure_ascii=False) + '\n'
+
+        with self.lock, io.open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def read_cassette(path: str) -> list[dict]:
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class Cassette:
+    def __init__(self, exchanges: Iterable[dict]):
+        self.origins = []
+        self.responses = defaultdict(list)
+        self.served = defaultdict(int)
+        self.lock = threading.Lock()
+
+        for exchange in exchanges:
+            origin = get_origin(exchange['url'])
+            if origin not in self.origins:
+                self.origins.append(origin)
+
+            for key in self.get_keys(exchange['method'], exchange['url'], exchange.get('request_body')):
+                self.responses[(origin, *key)].append(exchange)
+
+    @staticmethod
+    def get_keys(method: str, url: str, body: Optional[str]) -> list[tuple]:
+        # from the most to the least specific, a request with a new body is still answered by its endpoint
+        url = normalize_url(url)
+
+        # without a query the url and path keys are the same, each exchange is listed under a key only once
+        return list(dict.fromkeys([
+            (method, url, normalize_body(body)),
+            (method, url),
+            (method, url.split('?')[0]),
+        ]))
+
+    def match(self, origin: str, method: str, url: str, body: Optional[str]) -> Optional[dict]:
+        for key in self.get_keys(method, url, body):
+            key = (origin, *key)
+            responses = self.responses.get(key)
+
+            if responses:
+                # repeated requests are answered in the recorded order, the last response is repeated
+                with self.lock:
+                    index = self.served[key]
+                    self.served[key] += 1
+
+                return responses[min(index, len(responses) - 1)]
+
+        return None
+
+
+class RateLimiter:
+    # token bucket, requests over the limit are answered with 429 like the real services do
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keeps connections alive, the clients reuse pooled connections like against the real services
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body leave in a single packet, otherwise delayed acks add 40 ms to every response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle_exchange(self):
+        server = self.server
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8', 'replace') if length else None
+
+        if server.rate_limiter is not None and not server.rate_limiter.acquire():
+            self.respond(429, {'Content-Type': 'text/plain', 'Retry-After': '1'}, 'rate limit exceeded')
+            return
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        exchange = server.cassette.match(server.origin, self.command, server.origin + self.path, body)
+
+        if exchange is None:
+            self.respond(404, {'Content-Type': 'text/plain'}, 'no recorded exchange for %s %s' % (self.command, self.path))
+            return
+
+        # links to the recorded service, e.g. next pages and redirects, have to lead back to the stand-in
+        headers = {name: value.replace(server.origin, server.url) for name, value in exchange['headers'].items()}
+        self.respond(exchange['status'], headers, exchange['body'].replace(server.origin, server.url))
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_exchange
+
+    def respond(self, status: int, headers: dict, content: str):
+        data = content.encode('utf-8')
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+            self,
+            cassette: Cassette,
+            origin: str,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            rate_limit: Optional[float] = None,
+            port: int = 0
+    ):
+        super().__init__(('127.0.0.1', port), StandInHandler)
+
+        self.cassette = cassette
+        self.origin = origin
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self) -> 'StandInServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def serve(
+        cassette: Cassette,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit: Optional[float] = None
+) -> dict[str, StandInServer]:
+    # every recorded service gets its own server, so the clients can keep their paths unchanged
+    return {
+        origin: StandInServer(cassette, origin, latency, jitter, rate_limit).start()
+        for origin in cassette.origins
+    }
+
+
+def get_service_settings(servers: dict[str, StandInServer]) -> dict[str, str]:
+    settings = {}
+
+    for name, url in http_client.SERVICE_URLS.items():
+        origin = get_origin(url)
+
+        if origin in servers:
+            settings[name] = servers[origin].url + url[len(origin):]
+
+    return settings
+
+
+def print_usage():
+    print('Usage: python http_replay.py CASSETTE [latency_ms] [requests_per_second]')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print_usage()
+        exit(1)
+
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    rate_limit = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    servers = serve(Cassette(read_cassette(sys.argv[1])), latency, rate_limit=rate_limit)
+
+    print('Serving %s, add these settings to .env of the run to replay:' % sys.argv[1])
+    for name, value in get_service_settings(servers).items():
+        print('%s=%s' % (name, value))
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.stop()
@@ -1,45 +1,60 @@
 import os
 import os.path
 import io
+import sys
+import time
 import json
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Iterable, Optional, Tuple
 
-import requests
 from dotenv import load_dotenv
-from dateutil import parser
-from jira import JIRA, Issue
 import base64
-from requests_ntlm import HttpNtlmAuth
-from bs4 import BeautifulSoup
 import re
 from datetime import datetime, timedelta, date
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import click
 
+import debug_files
+import http_client
+import itime_forms
+import jira_issue_cache
+import run_metrics
+import tempo_accounts
+import timesheet_matrix
+from jira_issue_cache import CachedIssue
+
+if TYPE_CHECKING:
+    import requests
+
 load_dotenv()
 
 jira_user_id = os.getenv('jira_user_id')
 
-jira = JIRA(
-    'https://ipsos-cx.atlassian.net/',
-    basic_auth=(os.getenv('jira_user_email'), os.getenv('jira_api_token'))
-)
-jira_issue_id_key_map = {}
-
-with io.open('jira_itime_task_mapping.json', 'r') as f:
-    jira_itime_task_mapping = json.load(f)
+jira_itime_task_mapping = None
 
 jira_account_itime_mapping = {}
 
-# create debug directory
-if not os.path.exists('debug'):
-    os.makedirs('debug')
+ITIME_REFERENCE_CACHE_PATH = 'debug/itime_reference_cache.json'
+ITIME_REFERENCE_CACHE_TTL_SECONDS = int(os.getenv('itime_cache_ttl', str(12 * 60 * 60)))
+itime_reference_cache = None
+
+
+def get_jira_itime_task_mapping() -> dict:
+    global jira_itime_task_mapping
+
+    if jira_itime_task_mapping is None:
+        with io.open('jira_itime_task_mapping.json', 'r') as f:
+            jira_itime_task_mapping = json.load(f)
+
+    return jira_itime_task_mapping
 
 
 def load_jira_account_itime_mapping():
     global jira_account_itime_mapping
 
+    debug_files.create_debug_directory()
+
     if not os.path.exists('debug/jira_account_mapping.json'):
         with io.open('debug/jira_account_mapping.json', 'w') as f:
             json.dump(jira_account_itime_mapping, f)
@@ -54,16 +69,67 @@ def save_jira_account_mapping():
         json.dump(jira_account_itime_mapping, f)
 
 
-jira_issue_tempo_account_custom_field = 'customfield_10032'
+def load_itime_reference_cache() -> dict:
+    global itime_reference_cache
+
+    if itime_reference_cache is None:
+        itime_reference_cache = {}
+
+        if os.path.exists(ITIME_REFERENCE_CACHE_PATH):
+            with io.open(ITIME_REFERENCE_CACHE_PATH, 'r') as f:
+                itime_reference_cache = json.load(f)
+
+        # cached responses are only valid for the user which fetched them
+        if itime_reference_cache.get('username') != itime_username:
+            itime_reference_cache = {'username': itime_username}
+
+    return itime_reference_cache
+
+
+def save_itime_reference_cache():
+    debug_files.create_debug_directory()
+
+    with io.open(ITIME_REFERENCE_CACHE_PATH, 'w') as f:
+        json.dump(load_itime_reference_cache(), f)
+
+
+def clear_itime_reference_cache():
+    global itime_reference_cache
+
+    itime_reference_cache = {'username': itime_username}
+    save_itime_reference_cache()
+
+
+def get_cached_itime_reference(name: str):
+    cached = load_itime_reference_cache().get(name)
+
+    if cached is None or time.time() - cached['fetched_at'] > ITIME_REFERENCE_CACHE_TTL_SECONDS:
+        run_metrics.cache_lookup('itime_reference', False)
+        return None
+
+    run_metrics.cache_lookup('itime_reference', True)
+    return cached['value']
+
+
+def set_cached_itime_reference(name: str, value, fetched_at: Optional[float] = None):
+    load_itime_reference_cache()[name] = {
+        'fetched_at': time.time() if fetched_at is None else fetched_at,
+        'value': value
+    }
+    save_itime_reference_cache()
+
+
+def update_cached_itime_reference(name: str, update):
+    cached = load_itime_reference_cache().get(name)
 
-tempo_api_url = 'https://api.tempo.io/4'
-tempo_token = os.getenv('tempo_api_token')
+    # our own changes are applied to the cached response, the original fetch time is kept
+    if cached is not None:
+        set_cached_itime_reference(name, update(cached['value']), cached['fetched_at'])
 
-tempo_auth_headers = {
-    'Authorization': f'Bearer {tempo_token}'
-}
 
-itime_base_url = 'https://itime.ipsos.com/'
+tempo_api_url = http_client.TEMPO_API_URL
+
+itime_base_url = http_client.ITIME_URL
 itime_url = '/iTime_CZ_SK/TmCrdForm.cfm'
 itime_login_url = '/default.cfm?Debug=On&OpenType=Default&OpenID=0'
 itime_home_url = '/iTime_CZ_SK/TmCrdForm.cfm'
@@ -79,15 +145,13 @@ itime_projects_search_url = '/iTime_CZ_SK/Emp_PrjctAcsForm.CFM'
 itime_projects_add_url = '/iTime_CZ_SK/EmplyPrjctAcsEntry.CFM'
 
 itime_username = os.getenv('itime_username')
-itime_password = base64.b64decode(os.getenv('itime_password_base_64').encode('ascii')).decode('ascii')
 
-session = requests.Session()
-session.auth = HttpNtlmAuth(itime_username, itime_password)
-session.headers = {
-    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-    'Accept-Language': 'en-GB,en;q=0.9',
-    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36',
-}
+
+def get_itime_session():
+    itime_password = base64.b64decode(os.getenv('itime_password_base_64').encode('ascii')).decode('ascii')
+
+    return http_client.get_itime_session(itime_username, itime_password)
+
 
 # login to itime
 
@@ -96,6 +160,22 @@ ITIME_JSON_DATE_FORMAT = '%m/%d/%Y'
 TIME_CARD_DATE_REGEX = re.compile(r'\d{2}/\d{2}/\d{4}')
 
 TEMPO_DATE_FORMAT = '%Y-%m-%d'
+TEMPO_SEARCH_PAGE_LIMIT = 1000
+TEMPO_SEARCH_WINDOW_DAYS = int(os.getenv('tempo_search_window_days', '7'))
+TEMPO_SEARCH_WORKERS = int(os.getenv('tempo_search_workers', '4'))
+
+# project searches for unknown accounts run concurrently, itime answers each of them slowly
+ITIME_PROJECT_SEARCH_WORKERS = int(os.getenv('itime_project_search_workers', '4'))
+
+# reports are saved and verified before they are submitted, submitting right away saves a round trip
+# but relies on itime recalculating the totals on submit, which hasn't been confirmed yet
+ITIME_SUBMIT_WITHOUT_SAVE = os.getenv('itime_submit_without_save', 'false').lower() == 'true'
+
+# saved hours are compared with the sent ones with the precision of the form
+ITIME_HOURS_TOLERANCE = 0.005
+
+# maximum number of pending weeks submitted by a single catch-up run
+CATCH_UP_WEEKS = int(os.getenv('itime_catch_up_weeks', '8'))
 
 WEEK_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
@@ -109,37 +189,12 @@ def load_itime_cookies():
         for cookie in itime_cookies:
             cookie = cookie.strip()
             cookie = cookie.split('=')
-            session.cookies.set(cookie[0], cookie[1])
-
-
-def debug_file(name: str, content: str):
-    with io.open(name, 'w') as f:
-        f.write(content)
-
-
-def itime_request(method: str, url: str, **kwargs: any) -> requests.Response:
-    response = session.request(method, itime_base_url + url, **kwargs)
-
-    if 'debug_file' in kwargs:
-        request_data = []
-
-        for r in response.history:
-            request_data.append(
-                {
-                    'url': r.request.url,
-                    'body': r.request.body,
-                    'headers': dict(r.request.headers),
-                    'response': {
-                        'status': r.status_code,
-                        'headers': dict(r.headers),
-                        'cookies': r.cookies.get_dict()
-                    }
-                }
-            )
+            get_itime_session().cookies.set(cookie[0], cookie[1])
 
-        debug_file(kwargs['debug_file'], json.dumps(request_data))
 
-    return response
+def itime_request(method: str, url: str, **kwargs: any) -> 'requests.Response':
+    # exchanges, redirects included, are recorded by http_client when http_record_path is set
+    return get_itime_session().request(method, itime_base_url + url, **kwargs)
 
 
 def itime_login():
@@ -160,6 +215,7 @@ def itime_login():
 
 
 def check_jira_itime_task_mapping():
+    jira_itime_task_mapping = get_jira_itime_task_mapping()
     tasks = set(list(jira_itime_task_mapping['issues'].values()) + list(jira_itime_task_mapping['projects'].values()))
 
     for task in tasks:
@@ -167,7 +223,19 @@ def check_jira_itime_task_mapping():
             raise ValueError('task %s has not associated name in jira_itime_task_mapping.json' % task)
 
 
-def get_tempo_worklogs(date_from: datetime, date_to: datetime):
+def split_tempo_date_range(date_from: date, date_to: date, window_days: int = TEMPO_SEARCH_WINDOW_DAYS):
+    # tempo date ranges are inclusive on both ends
+    window_from = date_from
+
+    while window_from <= date_to:
+        window_to = min(window_from + timedelta(days=window_days - 1), date_to)
+
+        yield window_from, window_to
+
+        window_from = window_to + timedelta(days=1)
+
+
+def get_tempo_worklog_pages(date_from: date, date_to: date):
     get_data = {
         'authorIds': [
             jira_user_id
@@ -176,23 +244,60 @@ def get_tempo_worklogs(date_from: datetime, date_to: datetime):
         'to': date_to.strftime(TEMPO_DATE_FORMAT)
     }
 
-    response = requests.post(
-        f'{tempo_api_url}/worklogs/search?limit=1000',
-        headers=tempo_auth_headers,
-        json=get_data
-    )
+    url = f'{tempo_api_url}/worklogs/search'
+    params = {'offset': 0, 'limit': TEMPO_SEARCH_PAGE_LIMIT}
+
+    while url is not None:
+        response = http_client.get_tempo_session().post(
+            url,
+            params=params,
+            json=get_data
+        )
+        response.raise_for_status()
+
+        page = response.json()
+        yield page['results']
+
+        # the next page link already carries offset and limit
+        url = page['metadata'].get('next')
+        params = None
+
+
+@run_metrics.stage('tempo_search')
+def get_tempo_worklogs_in_range(date_from: date, date_to: date) -> list[dict]:
+    worklogs = []
+
+    for page in get_tempo_worklog_pages(date_from, date_to):
+        worklogs.extend(page)
 
-    return response.json()['results']
+    return worklogs
 
 
-def get_jira_issue_by_id(issue_id: str) -> Issue:
-    if issue_id not in jira_issue_id_key_map:
-        jira_issue_id_key_map[issue_id] = jira.issue(issue_id)
+def get_tempo_worklogs(date_from: date, date_to: date):
+    with ThreadPoolExecutor(max_workers=TEMPO_SEARCH_WORKERS) as executor:
+        pending = deque()
 
-    return jira_issue_id_key_map[issue_id]
+        for window in split_tempo_date_range(date_from, date_to):
+            pending.append(executor.submit(get_tempo_worklogs_in_range, *window))
 
+            if len(pending) >= TEMPO_SEARCH_WORKERS:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+
+def get_jira_issue_by_id(issue_id: str) -> CachedIssue:
+    return jira_issue_cache.get_issue(http_client.get_jira_client(), issue_id)
+
+
+def get_jira_issues_by_ids(issue_ids: Iterable[int]) -> dict[int, CachedIssue]:
+    return jira_issue_cache.get_issues(http_client.get_jira_client(), issue_ids)
+
+
+def get_task_for_issue(project_id: str, jira_issue: CachedIssue) -> str:
+    jira_itime_task_mapping = get_jira_itime_task_mapping()
 
-def get_task_for_issue(project_id: str, jira_issue: Issue) -> str:
     if jira_issue.key in jira_itime_task_mapping['issues']:
         return jira_itime_task_mapping['issues'][jira_issue.key]
 
@@ -202,72 +307,118 @@ def get_task_for_issue(project_id: str, jira_issue: Issue) -> str:
     return jira_itime_task_mapping['default']
 
 
-def get_jira_entries(date_from: datetime, date_to: datetime):
+def get_jira_entries(
+        date_from: date,
+        date_to: date,
+        worklogs: Optional[Iterable[dict]] = None,
+        issue_account_map: Optional[dict[int, str]] = None
+) -> dict:
     print('Fetching jira time entries...')
-    accounts = defaultdict(
-        lambda: defaultdict(
-            lambda: defaultdict(
-                lambda: defaultdict(dict)
-            )
-        )
-    )
-    issue_account_map = {}
 
-    def get_issue_account_and_task(issue_id: int):
-        if issue_id not in issue_account_map:
-            issue = get_jira_issue_by_id(str(issue_id))
+    if issue_account_map is None:
+        issue_account_map = {}
 
-            tempo_custom_field = issue.raw['fields'][jira_issue_tempo_account_custom_field]
+    if worklogs is None:
+        worklogs = get_tempo_worklogs(date_from, date_to)
 
-            if tempo_custom_field is None:
-                print('Jira issue %s has no associated account with it.' % issue.key)
-                print('Do you want to enter it manually? Enter account name or leave blank to terminate and press '
-                      'enter.')
-                account_name = input('Account name: ')
+    # only the fields needed for aggregation are kept from each worklog
+    entries = []
+    for worklog in worklogs:
+        entries.append((worklog['issue']['id'], worklog['startDate'], int(worklog['timeSpentSeconds'])))
+
+    # accounts of all issues in the batch are resolved at once, issues without one are asked for at the end
+    unresolved = [
+        issue_id for issue_id in dict.fromkeys(entry[0] for entry in entries)
+        if issue_id not in issue_account_map
+    ]
+
+    with run_metrics.stage('issue_resolution'):
+        issues = get_jira_issues_by_ids(unresolved)
+
+    issues_without_account = []
+    account_ids = {}
+    for issue_id in unresolved:
+        if issues[issue_id].account is None:
+            issues_without_account.append(issue_id)
+        else:
+            issue_account_map[issue_id] = issues[issue_id].account
+            account_ids[issues[issue_id].account] = issues[issue_id].account_id
 
-                if account_name == '':
-                    print('Exiting...')
-                    exit(1)
-            else:
-                account_name = tempo_custom_field['value'].strip()
+    if issues_without_account:
+        print('These Jira issues have no associated account with them:')
+        for issue_id in issues_without_account:
+            print('  %s' % issues[issue_id].key)
 
-            issue_account_map[issue_id] = account_name
+        print('Do you want to enter them manually? Enter account name for each issue or leave blank to terminate and '
+              'press enter.')
 
-        return issue_account_map[issue_id]
+        for issue_id in issues_without_account:
+            account_name = input('Account name for %s: ' % issues[issue_id].key)
 
-    worklogs = get_tempo_worklogs(date_from, date_to)
+            if account_name == '':
+                print('Exiting...')
+                exit(1)
 
-    for worklog in worklogs:
-        account = get_issue_account_and_task(worklog['issue']['id'])
+            issue_account_map[issue_id] = account_name
 
-        date_key = parser.parse(worklog['startDate']).strftime(ITIME_DATE_FORMAT)
+    return {
+        'worklogs': entries,
+        'accounts': issue_account_map,
+        'account_ids': account_ids,
+    }
 
-        if date_key not in accounts[account]['entries']:
-            accounts[account]['entries'][date_key] = 0
 
-        if date_key not in accounts[account]['issues'][worklog['issue']['id']]:
-            accounts[account]['issues'][worklog['issue']['id']][date_key] = 0
+def get_jira_accounts(entries: dict) -> list[str]:
+    return sorted(set(entries['accounts'].values()))
 
-        accounts[account]['issues'][worklog['issue']['id']][date_key] += int(worklog['timeSpentSeconds'])
-        accounts[account]['entries'][date_key] += int(worklog['timeSpentSeconds'])
 
-    return accounts
+def get_timesheets(start_year: int) -> dict[str, list[str]]:
+    cached = get_cached_itime_reference('timesheets')
 
+    if cached is not None and cached['start_year'] <= start_year:
+        return cached['data']
 
-def get_next_timesheet() -> Optional[Tuple[date, str]]:
-    current_year = date.today().year
-    next_year = current_year + 1
+    next_year = date.today().year + 1
 
     response = itime_request(
         'POST',
         itime_existing_sheets_url,
         data={
-            'startDate': '01/01/' + str(current_year),
+            'startDate': '01/01/' + str(start_year),
             'endDate': '01/01/' + str(next_year),
         }
     )
     data = response.json()
 
+    set_cached_itime_reference('timesheets', {'start_year': start_year, 'data': data})
+
+    return data
+
+
+def mark_timesheet_submitted(end_date: date):
+    sheet_prefix = end_date.strftime(ITIME_JSON_DATE_FORMAT) + '^'
+
+    def remove_sheet(cached: dict) -> dict:
+        for status in ('Created_not_submitted', 'Missing_late', 'future_notcreated'):
+            cached['data'][status] = [sheet for sheet in cached['data'][status] if not sheet.startswith(sheet_prefix)]
+
+        return cached
+
+    update_cached_itime_reference('timesheets', remove_sheet)
+
+
+def parse_timesheet(sheet: str) -> Tuple[date, str]:
+    # 06/15/2025^123456
+    split = sheet.split('^')
+    end_date = datetime.strptime(split[0], ITIME_JSON_DATE_FORMAT).date()
+    timecard_id = split[1]
+
+    return end_date, str(timecard_id)
+
+
+def get_next_timesheet() -> Optional[Tuple[date, str]]:
+    data = get_timesheets(date.today().year)
+
     existing_sheets = data['Created_not_submitted']
 
     next_sheet = existing_sheets[0] if existing_sheets else None
@@ -281,16 +432,38 @@ def get_next_timesheet() -> Optional[Tuple[date, str]]:
         next_sheet = future_sheets[0] if future_sheets else None
 
     if next_sheet is not None:
-        # 06/15/2025
-        split = next_sheet.split('^')
-        end_date = datetime.strptime(split[0], ITIME_JSON_DATE_FORMAT).date()
-        timecard_id = split[1]
-
-        return end_date, str(timecard_id)
+        return parse_timesheet(next_sheet)
 
     return None
 
 
+def is_week_submittable(to_date: date) -> bool:
+    today = date.today()
+
+    return to_date <= today or to_date.isocalendar().week == today.isocalendar().week
+
+
+@run_metrics.stage('itime_timesheets')
+def get_pending_weeks(catch_up_weeks: int) -> list[Tuple[str, date, date]]:
+    itime_request('GET', itime_home_url)
+
+    # pending weeks may reach into the previous year at the beginning of a year
+    start_year = (date.today() - timedelta(weeks=catch_up_weeks)).year
+    data = get_timesheets(start_year)
+
+    weeks = {}
+    for sheet in data['Created_not_submitted'] + data['Missing_late'] + data['future_notcreated']:
+        end_date, time_card_id = parse_timesheet(sheet)
+
+        if not is_week_submittable(end_date) or end_date in weeks:
+            continue
+
+        weeks[end_date] = (time_card_id, end_date - timedelta(days=6), end_date)
+
+    return [weeks[end_date] for end_date in sorted(weeks)][:catch_up_weeks]
+
+
+@run_metrics.stage('itime_timesheets')
 def get_first_not_submitted_week() -> (str, date, date):
     itime_request('GET', itime_home_url)
 
@@ -311,7 +484,8 @@ PROJECT_ID_REGEX = re.compile(r"(?:\d{2}-\d{6}(?:[\d-]+)?)|\d{8,}")
 SEARCH_PROJECTS_LIST_ID = 'Prjct_Lst'
 
 
-def find_and_add_itime_project(jira_account: str, project_id: str, existing_projects: dict[str, str]) -> str:
+@run_metrics.stage('itime_project_search')
+def search_itime_projects(project_id: str) -> list[tuple[str, str]]:
     response = itime_request('POST', itime_projects_search_url, data={
         'vExpandPPLFlag': 'N',
         'vExpandSFlag': 'Y',
@@ -320,174 +494,229 @@ def find_and_add_itime_project(jira_account: str, project_id: str, existing_proj
         'GetQProjects': 'Get Projects'
     })
 
-    search_soup = BeautifulSoup(response.text, 'html5lib')
+    # the result page is parsed in the worker thread too
+    project_list = itime_forms.extract_options(response.text, SEARCH_PROJECTS_LIST_ID)
 
-    project_list = search_soup.select('#' + SEARCH_PROJECTS_LIST_ID + ' option')
-
-    if len(project_list) == 1 and project_list[0].attrs['value'] == '':
+    if len(project_list) == 1 and project_list[0][0] == '':
         project_list = []
 
-    exact_match = list(filter(lambda x: x.attrs['value'] == project_id, project_list))
+    exact_match = list(filter(lambda x: x[0] == project_id, project_list))
 
     if len(exact_match) != 0:
         project_list = [exact_match[0]]
 
-    if len(project_list) != 1:
-        if len(project_list) == 0:
-            print('Project id "%s" not found for jira account %s' % (project_id, jira_account))
-        else:
-            print('Multiple projects found:')
+    return project_list
 
-            print('---')
 
-            for project in project_list:
-                print('%s (%s)' % (project.attrs['value'], project.text))
+def search_itime_projects_concurrently(project_ids: Iterable[str]) -> dict[str, list[tuple[str, str]]]:
+    project_ids = list(dict.fromkeys(project_ids))
 
-            print('---')
+    with ThreadPoolExecutor(max_workers=ITIME_PROJECT_SEARCH_WORKERS) as executor:
+        return dict(zip(project_ids, executor.map(search_itime_projects, project_ids)))
 
-        project_id = input('Enter correct project id or empty to terminate: ')
 
-        if project_id == '':
-            print('Exiting...')
-            exit(1)
+def find_itime_projects(account_project_ids: dict[str, str]) -> dict[str, str]:
+    found = {}
+    pending = dict(account_project_ids)
+
+    while pending:
+        results = search_itime_projects_concurrently(pending.values())
+        ambiguous = {}
+
+        for jira_account, project_id in pending.items():
+            if len(results[project_id]) == 1:
+                found[jira_account] = results[project_id][0][0]
+            else:
+                ambiguous[jira_account] = project_id
+
+        # all accounts without a single matching project are resolved together once the searches are done
+        pending = {}
 
-        return find_and_add_itime_project(jira_account, project_id, existing_projects)
+        for jira_account, project_id in ambiguous.items():
+            project_list = results[project_id]
 
-    project_id = project_list[0].attrs['value']
+            if len(project_list) == 0:
+                print('Project id "%s" not found for jira account %s' % (project_id, jira_account))
+            else:
+                print('Multiple projects found for jira account %s:' % jira_account)
 
-    jira_account_itime_mapping[jira_account] = project_id  # TODO: update account mapping file
+                print('---')
 
-    if project_id in existing_projects:
-        return project_id
+                for project_value, project_name in project_list:
+                    print('%s (%s)' % (project_value, project_name))
 
-    print('Adding project "%s" to itime' % project_id)
-    itime_request('POST', itime_projects_add_url, data={
+                print('---')
+
+            project_id = input('Enter correct project id or empty to terminate: ')
+
+            if project_id == '':
+                print('Exiting...')
+                exit(1)
+
+            pending[jira_account] = project_id
+
+    return found
+
+
+def post_personal_projects(project_ids: list[str]) -> list[str]:
+    # the project list is a multi-select, all selected projects are moved to the personal list at once
+    response = itime_request('POST', itime_projects_add_url, data={
         'vExpandPPLFlag': 'N',
         'vExpandSFlag': 'Y',
         'BU_ID': '0',
         'Project_Type': 'All',
         'Project_Name': '',
         'Client_Name': '',
-        'Project_ID': project_id,
+        'Project_ID': project_ids[0] if len(project_ids) == 1 else '',
         'sortOrder1': 'JBNum',
         'sortOrder2': 'None',
         'sortOrder3': 'None',
         'Global': '0',
         'GlobalLEID': '',
-        'Prjct_Lst': project_id,
+        'Prjct_Lst': project_ids,
         'MoveTo': '\xa0\xa0\xa0Add to personal list \xa0\xa0\xa0'
     })
+    response.raise_for_status()
 
-    existing_projects[project_id] = project_id
-    return project_id
+    # the personal list is usually returned with the response, otherwise it is read again
+    projects = [value for value, name in itime_forms.extract_options(response.text, PERSONAL_PROJECTS_LIST_ID)]
 
+    if not projects:
+        projects = fetch_personal_projects()
 
-def match_accounts_with_itime_projects(jira_accounts: list[str]) -> dict[str, str]:
-    print('Matching jira accounts...')
+    return projects
+
+
+def add_itime_projects(project_ids: list[str]):
+    print('Adding projects %s to itime' % ', '.join('"%s"' % project_id for project_id in project_ids))
+
+    personal_projects = post_personal_projects(project_ids)
+    missing = [project_id for project_id in project_ids if project_id not in personal_projects]
+
+    # projects not added by the batch are added one by one
+    if missing and len(project_ids) > 1:
+        for project_id in missing:
+            personal_projects = post_personal_projects([project_id])
+
+        missing = [project_id for project_id in project_ids if project_id not in personal_projects]
+
+    set_cached_itime_reference('personal_projects', personal_projects)
+
+    if missing:
+        print('Projects %s could not be added to itime, add them manually and try again.' % ', '.join(
+            '"%s"' % project_id for project_id in missing
+        ))
+        exit(1)
+
+
+def fetch_personal_projects() -> list[str]:
     response = itime_request('GET', itime_projects_url, params={'TimeCard_ID': '0'})
 
-    soup = BeautifulSoup(response.text, 'html5lib')
+    return [value for value, name in itime_forms.extract_options(response.text, PERSONAL_PROJECTS_LIST_ID)]
 
-    project_list = soup.select_one('#' + PERSONAL_PROJECTS_LIST_ID)
 
-    existing_projects = dict(
-        list(
-            map(
-                lambda tag: (tag.attrs['value'], tag.attrs['value']),
-                project_list.select('option')
-            )
-        )
-    )
-    existing_projects['Admin'] = 'Admin'
+def get_personal_projects() -> list[str]:
+    cached = get_cached_itime_reference('personal_projects')
 
-    existing_projects = {**existing_projects, **jira_account_itime_mapping}
+    if cached is not None:
+        return cached
 
-    for jira_account in jira_accounts:
-        project_id_match = re.findall(PROJECT_ID_REGEX, jira_account)
+    projects = fetch_personal_projects()
+    set_cached_itime_reference('personal_projects', projects)
 
-        if len(project_id_match) == 0:
-            account_id = jira_account.split(' ')[0]
-        else:
-            account_id = project_id_match[0]
+    return projects
 
-        if account_id not in existing_projects:
-            itime_project_id = find_and_add_itime_project(jira_account, account_id, existing_projects)
-            existing_projects[account_id] = itime_project_id
 
-        existing_projects[jira_account] = existing_projects[account_id]
+def get_account_project_id(jira_account: str, account_id: Optional[int] = None) -> str:
+    # account names aren't unique, only accounts entered by hand are looked up by their name,
+    # the project id is taken from the tempo account key first
+    if account_id is not None:
+        account_key = tempo_accounts.get_account_key_by_id(account_id)
+    else:
+        account_key = tempo_accounts.get_account_key(jira_account)
 
-    return existing_projects
+    for source in (account_key, jira_account):
+        if source is None:
+            continue
 
+        project_id_match = re.findall(PROJECT_ID_REGEX, source)
 
-def format_seconds_for_itime(seconds: int) -> str:
-    hours = seconds / 60 / 60
-    return '%.2f' % hours
+        if len(project_id_match) != 0:
+            return project_id_match[0]
 
+    return account_key if account_key is not None else jira_account.split(' ')[0]
 
-def group_jira_entries_by_account_and_task(entries: dict, account_mapping: dict[str, str]) -> dict[str, dict[str, any]]:
-    account_task_entries = {}
 
-    for jira_account, account_entry in entries.items():
-        for issue_id, day_entries in account_entry['issues'].items():
-            issue = get_jira_issue_by_id(issue_id)
+@run_metrics.stage('itime_project_matching')
+def match_accounts_with_itime_projects(
+        jira_accounts: list[str],
+        jira_account_ids: Optional[dict[str, int]] = None
+) -> dict[str, str]:
+    print('Matching jira accounts...')
 
-            itime_project = account_mapping[jira_account]
-            itime_task = get_task_for_issue(itime_project, issue)
+    existing_projects = {project: project for project in get_personal_projects()}
+    existing_projects['Admin'] = 'Admin'
 
-            if itime_project not in account_task_entries:
-                account_task_entries[itime_project] = {}
+    existing_projects = {**existing_projects, **jira_account_itime_mapping}
 
-            if itime_task not in account_task_entries[itime_project]:
-                account_task_entries[itime_project][itime_task] = {}
+    account_ids = {
+        jira_account: get_account_project_id(jira_account, (jira_account_ids or {}).get(jira_account))
+        for jira_account in jira_accounts
+    }
+    unmatched = {
+        jira_account: account_id for jira_account, account_id in account_ids.items()
+        if account_id not in existing_projects
+    }
 
-            for day_date, seconds in day_entries.items():
-                if day_date not in account_task_entries[itime_project][itime_task]:
-                    account_task_entries[itime_project][itime_task][day_date] = 0
+    found = find_itime_projects(unmatched)
 
-                account_task_entries[itime_project][itime_task][day_date] += seconds
+    new_projects = list(dict.fromkeys(
+        itime_project_id for itime_project_id in found.values() if itime_project_id not in existing_projects
+    ))
 
-    return account_task_entries
+    # accounts are mapped only once their projects are confirmed on the personal list
+    if new_projects:
+        add_itime_projects(new_projects)
 
+    for jira_account, itime_project_id in found.items():
+        jira_account_itime_mapping[jira_account] = itime_project_id  # TODO: update account mapping file
 
-def get_submit_form_default_data(time_card_id: str) -> dict[str, str]:
-    response = itime_request('GET', itime_timesheet_detail_url, params={'TimeCard_ID': time_card_id})
-    soup = BeautifulSoup(response.text, 'html5lib')
+    for itime_project_id in new_projects:
+        existing_projects[itime_project_id] = itime_project_id
 
-    form_data = {}
-    inputs = soup.select('form input, form select, form textarea')
+    for jira_account, itime_project_id in found.items():
+        existing_projects[unmatched[jira_account]] = itime_project_id
 
-    for input_element in inputs:
-        if 'name' not in input_element.attrs:
-            continue
+    for jira_account, account_id in account_ids.items():
+        existing_projects[jira_account] = existing_projects[account_id]
 
-        input_value = ''
-        if input_element.name == 'input' or input_element.name == 'textarea':
-            if 'value' in input_element.attrs:
-                input_value = input_element.attrs['value']
-        elif input_element.name == 'select':
-            selected = input_element.select_one('option[selected]')
+    return existing_projects
 
-            if selected is None:
-                selected = input_element.select_one('option:first-child')
 
-            if selected is not None and 'value' in selected.attrs:
-                input_value = selected.attrs['value']
+def format_seconds_for_itime(seconds: int) -> str:
+    hours = seconds / 60 / 60
+    return '%.2f' % hours
 
-        form_data[input_element.attrs['name']] = input_value
 
-    return form_data
+@run_metrics.stage('aggregation')
+def aggregate_jira_entries(
+        entries: dict,
+        account_mapping: dict[str, str],
+        week_starts: list[date]
+) -> dict[date, timesheet_matrix.WeekMatrix]:
+    def get_row_key(issue_id: int) -> timesheet_matrix.RowKey:
+        itime_project = account_mapping[entries['accounts'][issue_id]]
+        itime_task = get_task_for_issue(itime_project, get_jira_issue_by_id(str(issue_id)))
 
+        return itime_project, itime_task
 
-def get_week_day_map(date_from: date) -> dict[str, str]:
-    days = {}
-    current_date = date_from
-    i = 0
-    while i < 7:
-        days[current_date.strftime(ITIME_DATE_FORMAT)] = WEEK_DAYS[i]
-        current_date += timedelta(days=1)
-        i += 1
+    return timesheet_matrix.aggregate_weeks(entries['worklogs'], week_starts, get_row_key)
 
-    return days
+
+def get_submit_form_default_data(time_card_id: str) -> dict[str, str]:
+    response = itime_request('GET', itime_timesheet_detail_url, params={'TimeCard_ID': time_card_id})
+
+    return itime_forms.extract_form_fields(response.text)
 
 
 def validate_date_range(date_from: date, date_to: date):
@@ -504,106 +733,171 @@ def validate_date_range(date_from: date, date_to: date):
 
 def process_project_task(
         row_index: int,
-        week_day_map: dict[str, str],
         form_data: dict[str, str],
         itime_project: str,
         itime_task: str,
-        project_entries: dict[str, int]
-) -> dict[str, int]:
+        day_seconds: list[int]
+):
     row_prefix = 'r' + str(row_index) + '_'
 
     form_data[row_prefix + 'PrjctCDName'] = ''
     form_data[row_prefix + 'Projname'] = itime_project
     form_data[row_prefix + 'Taskname'] = itime_task
-    form_data[row_prefix + 'Taskname_Dscr'] = jira_itime_task_mapping['task_names'][itime_task]
+    form_data[row_prefix + 'Taskname_Dscr'] = get_jira_itime_task_mapping()['task_names'][itime_task]
 
-    total_seconds = 0
+    for day_index, seconds in enumerate(day_seconds):
+        form_data[row_prefix + WEEK_DAYS[day_index]] = format_seconds_for_itime(seconds) if seconds else '0'
 
-    day_totals = {}
-
-    for day_date, day in week_day_map.items():
-        if day_date not in project_entries:
-            form_data[row_prefix + day] = '0'
-        else:
-            form_data[row_prefix + day] = format_seconds_for_itime(project_entries[day_date])
-
-        day_totals[day] = project_entries[day_date] if day_date in project_entries else 0
-
-    form_data['tot2' + str(row_index)] = format_seconds_for_itime(total_seconds)
-
-    return day_totals
+    form_data['tot2' + str(row_index)] = format_seconds_for_itime(sum(day_seconds))
 
 
 def submit_report(
         time_card_id: str,
         date_from: date,
         date_to: date,
-        entries: dict,
-        account_mapping: dict[str, str]
+        week_matrix: timesheet_matrix.WeekMatrix
 ):
     print('Creating itime report...')
     validate_date_range(date_from, date_to)
 
-    form_data = get_submit_form_default_data(time_card_id)
-    days = get_week_day_map(date_from)
+    with run_metrics.stage('itime_form_building'):
+        form_data = build_report_form(time_card_id, week_matrix)
+
+    with run_metrics.stage('itime_submission'):
+        submitted_fields = post_report_form(time_card_id, form_data)
 
-    account_task_map = group_jira_entries_by_account_and_task(entries, account_mapping)
+    mismatches = []
 
-    day_totals = {}
-    for day in days.values():
-        day_totals[day] = 0
+    if ITIME_SUBMIT_WITHOUT_SAVE:
+        with run_metrics.stage('itime_verification'):
+            submitted_fields = get_timecard_fields(time_card_id, submitted_fields)
+            mismatches = get_report_mismatches(form_data, submitted_fields)
 
-    row = 1
-    for itime_project, task_entries in account_task_map.items():
-        for itime_task, day_entries in task_entries.items():
-            task_day_totals = process_project_task(row, days, form_data, itime_project, itime_task, day_entries)
+    # the timecard is submitted either way, sending it again wouldn't fix it
+    mark_timesheet_submitted(date_to)
 
-            for day, seconds in task_day_totals.items():
-                day_totals[day] += seconds
+    if mismatches:
+        print_report_mismatches(mismatches)
+        print('Report submitted, but check the timesheet in iTime.')
+    else:
+        print('Report successfully submitted!')
 
-        row += 1
 
-    form_data['TimeCardRowCount'] = str(row - 1)
-    form_data['CurrentTotalRows'] = str(row - 1)
+def build_report_form(time_card_id: str, week_matrix: timesheet_matrix.WeekMatrix) -> dict[str, str]:
+    form_data = get_submit_form_default_data(time_card_id)
+
+    # every (project, task) pair gets its own row
+    row_count = 0
+    for (itime_project, itime_task), day_seconds in week_matrix.rows():
+        row_count += 1
+        process_project_task(row_count, form_data, itime_project, itime_task, day_seconds)
 
-    day_index = 3
-    for day_seconds in day_totals.values():
+    form_data['TimeCardRowCount'] = str(row_count)
+    form_data['CurrentTotalRows'] = str(row_count)
+
+    day_totals = week_matrix.day_totals()
+    for day_index, day_seconds in enumerate(day_totals):
         day_seconds = format_seconds_for_itime(day_seconds)
 
-        form_data['tot1_c' + str(day_index)] = day_seconds
-        form_data['tot2_c' + str(day_index)] = day_seconds
-        day_index += 1
+        form_data['tot1_c' + str(day_index + 3)] = day_seconds
+        form_data['tot2_c' + str(day_index + 3)] = day_seconds
 
-    total = format_seconds_for_itime(sum(day_totals.values()))
+    total = format_seconds_for_itime(sum(day_totals))
     form_data['totHours1'] = total
     form_data['totHours2'] = total
 
-    print('Saving report...')
-    form_data['Save & ReCalculate'] = ''
-    itime_request(
-        'POST',
-        itime_timesheet_save_url,
-        data=form_data
-    )
-    form_data.pop('Save & ReCalculate')
+    return form_data
+
+
+def post_timecard(form_data: dict[str, str], action: str) -> dict[str, str]:
+    response = itime_request('POST', itime_timesheet_save_url, data={**form_data, action: ''})
+    response.raise_for_status()
+
+    return itime_forms.extract_form_fields(response.text)
+
+
+def get_timecard_fields(time_card_id: str, response_fields: dict[str, str]) -> dict[str, str]:
+    if 'TimeCardRowCount' in response_fields:
+        return response_fields
+
+    # itime answered with another page, the timecard is read back instead
+    return get_submit_form_default_data(time_card_id)
+
+
+def post_report_form(time_card_id: str, form_data: dict[str, str]) -> dict[str, str]:
+    if not ITIME_SUBMIT_WITHOUT_SAVE:
+        print('Saving report...')
+        saved_fields = get_timecard_fields(time_card_id, post_timecard(form_data, 'Save & ReCalculate'))
+        mismatches = get_report_mismatches(form_data, saved_fields)
+
+        # nothing is submitted yet, so the report can still be fixed in iTime
+        if mismatches:
+            print_report_mismatches(mismatches)
+            print('Check the timesheet in iTime. Exiting...')
+            exit(1)
 
     print('Submitting report...')
-    form_data['Submit'] = ''
-    itime_request(
-        'POST',
-        itime_timesheet_save_url,
-        data=form_data
-    )
 
-    print('Report successfully submitted!')
+    return post_timecard(form_data, 'Submit')
+
+
+def parse_itime_hours(value: Optional[str]) -> float:
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+
+def get_report_rows(fields: dict[str, str]) -> dict[Tuple[str, str], list[float]]:
+    # rows are keyed by project and task, itime may list them in another order than they were sent
+    rows = {}
+
+    for row_index in range(1, int(fields.get('TimeCardRowCount') or 0) + 1):
+        row_prefix = 'r' + str(row_index) + '_'
+
+        if row_prefix + 'Projname' not in fields:
+            continue
+
+        row_key = (fields[row_prefix + 'Projname'], fields.get(row_prefix + 'Taskname', ''))
+        hours = rows.setdefault(row_key, [0.0] * len(WEEK_DAYS))
+
+        for day_index, day in enumerate(WEEK_DAYS):
+            hours[day_index] += parse_itime_hours(fields.get(row_prefix + day))
+
+    return rows
+
+
+def get_report_mismatches(form_data: dict[str, str], saved_fields: dict[str, str]) -> list[str]:
+    saved_rows = get_report_rows(saved_fields)
+    mismatches = []
+
+    for (itime_project, itime_task), sent_hours in get_report_rows(form_data).items():
+        saved_hours = saved_rows.get((itime_project, itime_task))
+
+        if saved_hours is None:
+            if sum(sent_hours) > 0:
+                mismatches.append('%s / %s: row is missing' % (itime_project, itime_task))
+
+            continue
+
+        for day, sent, saved in zip(WEEK_DAYS, sent_hours, saved_hours):
+            if abs(sent - saved) >= ITIME_HOURS_TOLERANCE:
+                mismatches.append('%s / %s %s: sent %.2f h, saved %.2f h' % (itime_project, itime_task, day, sent, saved))
+
+    return mismatches
+
+
+def print_report_mismatches(mismatches: list[str]):
+    print('Saved report differs from the sent one:')
+    for mismatch in mismatches:
+        print('  ' + mismatch)
 
 
 def process():
     while True:
         time_card_id, from_date, to_date = get_first_not_submitted_week()
 
-        today = date.today()
-        if to_date > today and to_date.isocalendar().week != today.isocalendar().week:
+        if not is_week_submittable(to_date):
             print('Nothing more to submit')
             return
 
@@ -613,13 +907,51 @@ def process():
 
         print('Creating report for week %s - %s' % (from_date, to_date))
         entries = get_jira_entries(from_date, to_date)
-        account_mapping = match_accounts_with_itime_projects(list(entries.keys()))
-        submit_report(time_card_id, from_date, to_date, entries, account_mapping)
+        account_mapping = match_accounts_with_itime_projects(get_jira_accounts(entries), entries['account_ids'])
+        week_matrix = aggregate_jira_entries(entries, account_mapping, [from_date])[from_date]
+        submit_report(time_card_id, from_date, to_date, week_matrix)
+
+
+def process_catch_up(catch_up_weeks: int = CATCH_UP_WEEKS, confirm: bool = True) -> int:
+    weeks = get_pending_weeks(catch_up_weeks)
+
+    if not weeks:
+        print('Nothing more to submit')
+        return 0
+
+    print('Pending weeks:')
+    for time_card_id, from_date, to_date in weeks:
+        print('  %s - %s' % (from_date, to_date))
+
+    if confirm and not click.confirm('Do you want to create reports for all %d weeks' % len(weeks), default=True):
+        print('Exiting...')
+        return 0
+
+    # worklogs, issue accounts and itime projects are fetched once for the whole span
+    entries = get_jira_entries(weeks[0][1], weeks[-1][2])
+    account_mapping = match_accounts_with_itime_projects(get_jira_accounts(entries), entries['account_ids'])
+    week_matrices = aggregate_jira_entries(entries, account_mapping, [from_date for _, from_date, _ in weeks])
+
+    for time_card_id, from_date, to_date in weeks:
+        print('Creating report for week %s - %s' % (from_date, to_date))
+        submit_report(time_card_id, from_date, to_date, week_matrices[from_date])
+
+    return len(weeks)
 
 
 if __name__ == '__main__':
+    run_metrics.start()
+
     itime_login()
     load_jira_account_itime_mapping()
     check_jira_itime_task_mapping()
-    process()
+
+    if '--refresh' in sys.argv:
+        clear_itime_reference_cache()
+
+    if '--catch-up' in sys.argv:
+        process_catch_up()
+    else:
+        process()
+
     save_jira_account_mapping()
@@ -0,0 +1,132 @@
+from html.parser import HTMLParser
+
+# option lists are usually near the top of a page, parsing stops once the list has been read
+FEED_CHUNK_SIZE = 16 * 1024
+
+
+class FormFieldParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.fields = {}
+        self.form_depth = 0
+        self.select_name = None
+        self.select_value = None
+        self.select_has_selected = False
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if tag == 'form':
+            self.form_depth += 1
+            return
+
+        if self.form_depth == 0:
+            return
+
+        attrs = dict(attrs)
+
+        if tag == 'input' or tag == 'textarea':
+            if 'name' in attrs:
+                self.fields[attrs['name']] = attrs.get('value') or ''
+        elif tag == 'select':
+            self.close_select()
+            self.select_name = attrs.get('name')
+            self.select_value = None
+            self.select_has_selected = False
+
+            # keeps the field at its position in the document
+            if self.select_name is not None:
+                self.fields[self.select_name] = ''
+        elif tag == 'option' and self.select_name is not None:
+            # the first selected option wins, otherwise the first option
+            if 'selected' in attrs and not self.select_has_selected:
+                self.select_value = attrs.get('value') or ''
+                self.select_has_selected = True
+            elif self.select_value is None:
+                self.select_value = attrs.get('value') or ''
+
+    def handle_endtag(self, tag: str):
+        if tag == 'select':
+            self.close_select()
+        elif tag == 'form' and self.form_depth > 0:
+            self.close_select()
+            self.form_depth -= 1
+
+    def close_select(self):
+        if self.select_name is not None:
+            self.fields[self.select_name] = self.select_value or ''
+
+        self.select_name = None
+
+    def close(self):
+        super().close()
+        self.close_select()
+
+
+class OptionListParser(HTMLParser):
+    def __init__(self, element_id: str):
+        super().__init__(convert_charrefs=True)
+        self.element_id = element_id
+        self.element_tag = None
+        self.done = False
+        self.options = []
+        self.option_value = None
+        self.option_text = []
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if self.element_tag is None:
+            if dict(attrs).get('id') == self.element_id:
+                self.element_tag = tag
+
+            return
+
+        if tag == 'option':
+            # options are often left unclosed in iTime pages
+            self.close_option()
+            self.option_value = dict(attrs).get('value') or ''
+            self.option_text = []
+
+    def handle_data(self, data: str):
+        if self.option_value is not None:
+            self.option_text.append(data)
+
+    def handle_endtag(self, tag: str):
+        if self.element_tag is None:
+            return
+
+        if tag == 'option':
+            self.close_option()
+        elif tag == self.element_tag:
+            self.close_option()
+            self.element_tag = None
+            self.done = True
+
+    def close_option(self):
+        if self.option_value is not None:
+            self.options.append((self.option_value, ''.join(self.option_text)))
+
+        self.option_value = None
+
+    def close(self):
+        super().close()
+        self.close_option()
+
+
+def extract_form_fields(html: str) -> dict[str, str]:
+    parser = FormFieldParser()
+    parser.feed(html)
+    parser.close()
+
+    return parser.fields
+
+
+def extract_options(html: str, element_id: str) -> list[tuple[str, str]]:
+    parser = OptionListParser(element_id)
+
+    for offset in range(0, len(html), FEED_CHUNK_SIZE):
+        parser.feed(html[offset:offset + FEED_CHUNK_SIZE])
+
+        if parser.done:
+            return parser.options
+
+    parser.close()
+
+    return parser.options
@@ -1,93 +1,205 @@
+import hashlib
 import os
+import threading
 import time
+from typing import TYPE_CHECKING
 
-import requests
 import io
 import json
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from jira import JIRA
 import enquiries
 import pendulum
 
+import debug_files
+import http_client
+import jira_search
+import run_metrics
+import tempo_accounts
+
+if TYPE_CHECKING:
+    import requests
+
 ACCOUNT_FIELD = 'customfield_10032'
 
 load_dotenv()
 
-jira = JIRA(
-    'https://ipsos-cx.atlassian.net/',
-    basic_auth=(os.getenv('jira_user_email'), os.getenv('jira_api_token'))
-)
+user_id = os.getenv('jira_user_id')
 
-tempo_api_url = 'https://api.tempo.io/4'
-tempo_token = os.getenv('tempo_api_token')
-tempo_auth_headers = {
-    'Authorization': f'Bearer {tempo_token}',
-    "Accept": "application/json",
-    "Content-Type": "application/json"
-}
+ACCOUNT_UPDATE_WORKERS = int(os.getenv('jira_account_update_workers', '4'))
+ACCOUNT_UPDATE_RETRIES = int(os.getenv('jira_account_update_retries', '3'))
+ACCOUNT_UPDATE_THROTTLE_STATUSES = {429, 503}
 
-user_id = os.getenv('jira_user_id')
+# issues processed by an interrupted run, removed once a run finishes without failures
+ACCOUNT_UPDATE_CHECKPOINT_PATH = 'debug/account-update-checkpoint.jsonl'
+
+
+class AdaptiveLimit:
+    # the number of updates in flight is halved when jira throttles and grows by one after a full round of successes
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+
+                if pause <= 0 and self.in_flight < self.limit:
+                    break
+
+                self.condition.wait(pause if pause > 0 else None)
+
+            self.in_flight += 1
+
+    def release(self, throttled: bool, retry_after: float = 0.0):
+        with self.condition:
+            self.in_flight -= 1
+
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                self.successes += 1
+
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+
+            self.condition.notify_all()
+
+
+def get_retry_after(response: 'requests.Response', attempt: int) -> float:
+    retry_after = response.headers.get('Retry-After')
+
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
 
+    return float(2 ** attempt)
 
-def get_all_tempo_account_key_id_mapping(keys: list):
-    response = requests.post(
-        f'{tempo_api_url}/accounts/search',
-        headers=tempo_auth_headers,
-        params={
-            'limit': 500
-        },
-        json={
-            'keys': keys
-        }
-    )
 
-    mapping = {}
-    accounts = response.json()
+def update_issue_account(issue_url: str, account_id: int, limit: AdaptiveLimit):
+    # only the field is written, issue.update() would load the whole issue again after every update,
+    # the session does not retry, so throttling is only handled here together with the adaptive limit
+    for attempt in range(ACCOUNT_UPDATE_RETRIES + 1):
+        limit.acquire()
+        throttled = False
+        retry_after = 0.0
 
-    for account in accounts['results']:
-        mapping[account['key']] = account['id']
+        try:
+            with run_metrics.stage('jira_account_update'):
+                response = http_client.get_jira_session().put(issue_url, json={'fields': {ACCOUNT_FIELD: account_id}})
 
-    return mapping
+            if response.status_code in ACCOUNT_UPDATE_THROTTLE_STATUSES and attempt < ACCOUNT_UPDATE_RETRIES:
+                throttled = True
+                retry_after = get_retry_after(response, attempt)
+                run_metrics.increment('retries')
+                continue
 
+            response.raise_for_status()
 
-def search_all_issues(jql_query: str, batch_size: int = 100):
-    start_at = 0
+            return
+        finally:
+            limit.release(throttled, retry_after)
 
-    while True:
-        issues = jira.search_issues(jql_query, startAt=start_at, maxResults=batch_size)
 
-        if not issues:
-            break
+def get_run_id(date_from: str, account_map: dict) -> str:
+    return hashlib.sha1(json.dumps([date_from, account_map], sort_keys=True).encode('utf-8')).hexdigest()
 
-        yield from issues
 
-        start_at += len(issues)
+def load_checkpoint(run_id: str) -> set[str]:
+    if not os.path.exists(ACCOUNT_UPDATE_CHECKPOINT_PATH):
+        return set()
 
-        if len(issues) < batch_size:
-            break
+    with io.open(ACCOUNT_UPDATE_CHECKPOINT_PATH, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
 
-        time.sleep(0.5) # avoid rate limiting
+    if any(record['run'] != run_id for record in records):
+        print('Checkpoint belongs to a run with a different mapping or date, starting from the beginning')
+        os.remove(ACCOUNT_UPDATE_CHECKPOINT_PATH)
+        return set()
+
+    return {record['issue'] for record in records}
 
 
 def update_issues(date_from: str):
+    import requests
+
     with io.open('account_update_mapping.json', 'r') as f:
         account_map = json.load(f)
 
-    account_key_id_map = get_all_tempo_account_key_id_mapping(
-        list(account_map.values())
-    )
+    account_key_id_map = tempo_accounts.get_account_ids(account_map.values())
+
+    run_id = get_run_id(date_from, account_map)
+    processed = load_checkpoint(run_id)
+
+    if processed:
+        print(f'Resuming interrupted run, {len(processed)} issues were already processed')
+
+    debug_files.create_debug_directory()
+
+    limit = AdaptiveLimit(ACCOUNT_UPDATE_WORKERS)
+    counts = defaultdict(int)
+
+    with io.open(ACCOUNT_UPDATE_CHECKPOINT_PATH, 'a') as checkpoint, \
+            ThreadPoolExecutor(max_workers=ACCOUNT_UPDATE_WORKERS) as executor:
+        pending = deque()
+
+        def record(issue_key: str, status: str):
+            counts[status] += 1
+
+            if status != 'failed':
+                checkpoint.write(json.dumps({'run': run_id, 'issue': issue_key, 'status': status}) + '\n')
+                checkpoint.flush()
+
+        def collect(issue_key: str, future):
+            try:
+                future.result()
+            except requests.RequestException as error:
+                # timeouts and connection errors fail only their issue, the next run retries it
+                if error.response is not None:
+                    print(f'Failed to update issue {issue_key}: {error.response.status_code} {error.response.text}')
+                else:
+                    print(f'Failed to update issue {issue_key}: {error!r}')
+                record(issue_key, 'failed')
+                return
+
+            print(f'Updated issue {issue_key}')
+            record(issue_key, 'updated')
+
+        for (account_from, account_to) in account_map.items():
+            print(f'Updating account {account_from} to {account_to}')
+
+            account_to_id = account_key_id_map[account_to]
+
+            query = f'Account.key = {account_from} AND worklogDate > {date_from}'
+            issues = jira_search.search_all_issues(query, [])
+
+            for issue in issues:
+                if issue['key'] in processed:
+                    continue
+
+                # only a bounded number of updates is queued, the search keeps streaming meanwhile
+                pending.append((issue['key'], executor.submit(update_issue_account, issue['self'], account_to_id, limit)))
 
-    for (account_from, account_to) in account_map.items():
-        print(f'Updating account {account_from} to {account_to}')
+                if len(pending) >= ACCOUNT_UPDATE_WORKERS * 2:
+                    collect(*pending.popleft())
 
-        account_to_id = account_key_id_map[account_to]
+        while pending:
+            collect(*pending.popleft())
 
-        query = f'Account.key = {account_from} AND worklogDate > {date_from}'
-        issues = search_all_issues(query)
+    print(f'Updated {counts["updated"]} issues, {counts["failed"]} failed')
 
-        for issue in issues:
-            print(f'Updating issue {issue.key}')
-            issue.update(fields={ACCOUNT_FIELD: account_to_id})
+    if counts['failed']:
+        print('Run the update again to retry the failed issues')
+    else:
+        os.remove(ACCOUNT_UPDATE_CHECKPOINT_PATH)
 
 
 def choose_date():
@@ -123,4 +235,5 @@ def choose_date():
 
 
 if __name__ == '__main__':
+    run_metrics.start()
     update_issues(choose_date())
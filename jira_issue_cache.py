@@ -0,0 +1,204 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+import jira_search
+import run_metrics
+
+load_dotenv()
+
+ACCOUNT_FIELD = 'customfield_10032'
+
+CACHE_PATH = os.getenv('jira_issue_cache_path', 'debug/jira-issue-cache.sqlite')
+CACHE_TTL_SECONDS = int(os.getenv('jira_issue_cache_ttl', str(7 * 24 * 60 * 60)))
+CACHE_MAX_ISSUES = int(os.getenv('jira_issue_cache_max_issues', '5000'))
+CACHE_LOCK_TIMEOUT_SECONDS = 30
+
+# issues looked up by a single search, long id lists make the jql hit the url and query limits
+ISSUE_SEARCH_CHUNK_SIZE = 50
+
+
+class CachedIssue(NamedTuple):
+    id: int
+    key: str
+    project: str
+    account_id: Optional[int]
+    account: Optional[str]
+
+
+_connection = None
+_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+
+    if _connection is None:
+        directory = os.path.dirname(CACHE_PATH)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # team runs share the cache between processes, writers wait for each other instead of failing
+        _connection = sqlite3.connect(
+            CACHE_PATH,
+            timeout=CACHE_LOCK_TIMEOUT_SECONDS,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        _connection.execute('PRAGMA journal_mode=WAL')
+        _connection.executescript('''
+            CREATE TABLE IF NOT EXISTS issues (
+                id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL,
+                project TEXT NOT NULL,
+                account_id INTEGER,
+                account TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS issue_keys (
+                key TEXT PRIMARY KEY,
+                issue_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS issues_accessed_at ON issues (accessed_at);
+        ''')
+
+    return _connection
+
+
+def get_cached_issue(id_or_key: str) -> Optional[CachedIssue]:
+    id_or_key = str(id_or_key)
+
+    with _lock:
+        connection = get_connection()
+
+        if id_or_key.isdigit():
+            issue_id = int(id_or_key)
+        else:
+            row = connection.execute('SELECT issue_id FROM issue_keys WHERE key = ?', (id_or_key.upper(),)).fetchone()
+
+            if row is None:
+                return None
+
+            issue_id = row[0]
+
+        row = connection.execute(
+            'SELECT id, key, project, account_id, account, fetched_at FROM issues WHERE id = ?',
+            (issue_id,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        now = time.time()
+        if now - row[5] > CACHE_TTL_SECONDS:
+            return None
+
+        connection.execute('UPDATE issues SET accessed_at = ? WHERE id = ?', (now, issue_id))
+
+        return CachedIssue(*row[:5])
+
+
+def to_cached_issue(raw: dict) -> CachedIssue:
+    account_field = raw['fields'].get(ACCOUNT_FIELD)
+
+    return CachedIssue(
+        int(raw['id']),
+        raw['key'],
+        raw['fields']['project']['key'],
+        int(account_field['id']) if account_field is not None else None,
+        account_field['value'].strip() if account_field is not None else None,
+    )
+
+
+def store_issues(raw_issues: list[dict], requested_keys: Optional[dict[int, str]] = None) -> list[CachedIssue]:
+    cached_issues = [to_cached_issue(raw) for raw in raw_issues]
+
+    now = time.time()
+    issue_keys = []
+
+    for cached in cached_issues:
+        issue_keys.append((cached.key, cached.id))
+
+        # issue keys change when an issue is moved, the old key is kept as an alias
+        requested_key = (requested_keys or {}).get(cached.id)
+        if requested_key is not None and not str(requested_key).isdigit() and str(requested_key).upper() != cached.key:
+            issue_keys.append((str(requested_key).upper(), cached.id))
+
+    with _lock:
+        connection = get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            'INSERT OR REPLACE INTO issues (id, key, project, account_id, account, fetched_at, accessed_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(*cached, now, now) for cached in cached_issues]
+        )
+        connection.executemany('INSERT OR REPLACE INTO issue_keys (key, issue_id) VALUES (?, ?)', issue_keys)
+        evict(connection)
+        connection.execute('COMMIT')
+
+    return cached_issues
+
+
+def store_issue(issue, requested_key: Optional[str] = None) -> CachedIssue:
+    return store_issues([issue.raw], {int(issue.id): requested_key})[0]
+
+
+def evict(connection: sqlite3.Connection):
+    connection.execute(
+        'DELETE FROM issues WHERE id IN (SELECT id FROM issues ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+        (CACHE_MAX_ISSUES,)
+    )
+    connection.execute('DELETE FROM issue_keys WHERE issue_id NOT IN (SELECT id FROM issues)')
+
+
+def get_issue(jira, id_or_key: str) -> CachedIssue:
+    cached = get_cached_issue(id_or_key)
+    run_metrics.cache_lookup('jira_issues', cached is not None)
+
+    if cached is None:
+        issue = jira.issue(str(id_or_key), fields='project,' + ACCOUNT_FIELD)
+        cached = store_issue(issue, id_or_key)
+
+    return cached
+
+
+def get_issues(jira, issue_ids: Iterable[int]) -> dict[int, CachedIssue]:
+    import requests
+
+    issues = {}
+    missing = []
+
+    for issue_id in dict.fromkeys(int(issue_id) for issue_id in issue_ids):
+        cached = get_cached_issue(str(issue_id))
+        run_metrics.cache_lookup('jira_issues', cached is not None)
+
+        if cached is None:
+            missing.append(issue_id)
+        else:
+            issues[issue_id] = cached
+
+    # only the fields kept in the cache are requested, a whole chunk of issues costs a single call
+    for start in range(0, len(missing), ISSUE_SEARCH_CHUNK_SIZE):
+        chunk = missing[start:start + ISSUE_SEARCH_CHUNK_SIZE]
+        jql_query = 'id in (%s)' % ','.join(str(issue_id) for issue_id in chunk)
+
+        try:
+            raw_issues = list(jira_search.search_all_issues(jql_query, ['key', 'project', ACCOUNT_FIELD]))
+        except requests.HTTPError:
+            # jira rejects the whole query when one of its ids is gone or hidden, the chunk is fetched issue by issue below
+            continue
+
+        for cached in store_issues(raw_issues):
+            issues[cached.id] = cached
+
+    # issues the search doesn't return, e.g. deleted or hidden ones, are fetched on their own to get jira's error for them
+    for issue_id in missing:
+        if issue_id not in issues:
+            issues[issue_id] = get_issue(jira, str(issue_id))
+
+    return issues
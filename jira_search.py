@@ -0,0 +1,91 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from dotenv import load_dotenv
+
+import http_client
+import run_metrics
+
+load_dotenv()
+
+# enhanced search pages are larger when only a few fields are requested
+SEARCH_PAGE_SIZE = int(os.getenv('jira_search_page_size', '1000'))
+SEARCH_NEAR_LIMIT_PAUSE = 1.0
+SEARCH_RETRIES = 3
+SEARCH_RETRY_STATUSES = {429, 503}
+
+# not every jira version allowed by pyproject has a public call for the enhanced search,
+# the endpoint is called with a plain session, which keeps the rate limit headers available
+SEARCH_URL = http_client.JIRA_URL.rstrip('/') + '/rest/api/2/search/jql'
+
+
+def get_retry_after(response, default: float) -> float:
+    retry_after = response.headers.get('Retry-After')
+
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+
+    return default
+
+
+def get_search_pause(response) -> float:
+    # jira cloud reports when a client comes close to its rate limit, only then the search slows down
+    if response.headers.get('X-RateLimit-NearLimit', '').lower() != 'true':
+        return 0.0
+
+    return get_retry_after(response, SEARCH_NEAR_LIMIT_PAUSE)
+
+
+def fetch_issue_page(
+        jql_query: str,
+        fields: list[str],
+        batch_size: int,
+        page_token: Optional[str],
+        pause: float
+) -> tuple[dict, float]:
+    if pause > 0:
+        time.sleep(pause)
+
+    body = {
+        'jql': jql_query,
+        'fields': fields,
+        'maxResults': batch_size,
+    }
+
+    if page_token is not None:
+        body['nextPageToken'] = page_token
+
+    with run_metrics.stage('jira_search'):
+        for attempt in range(SEARCH_RETRIES + 1):
+            response = http_client.get_jira_session().post(SEARCH_URL, json=body)
+
+            if response.status_code not in SEARCH_RETRY_STATUSES or attempt == SEARCH_RETRIES:
+                break
+
+            run_metrics.increment('retries')
+            time.sleep(get_retry_after(response, float(2 ** attempt)))
+
+        response.raise_for_status()
+        page = response.json()
+
+    return page, get_search_pause(response)
+
+
+def search_all_issues(jql_query: str, fields: list[str], batch_size: int = SEARCH_PAGE_SIZE):
+    # yields raw issues with only the requested fields, key and self are always included
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_issue_page, jql_query, fields, batch_size, None, 0.0)
+
+        while future is not None:
+            page, pause = future.result()
+            page_token = page.get('nextPageToken')
+
+            # the next page is fetched while the caller works through the current one
+            if page_token is not None and not page.get('isLast', False):
+                future = executor.submit(fetch_issue_page, jql_query, fields, batch_size, page_token, pause)
+            else:
+                future = None
+
+            yield from page['issues']
@@ -1,46 +1,50 @@
+import asyncio
 import os
+import sys
 
-import requests
+import aiohttp
 import io
 import json
-from dateutil import parser
+from collections import defaultdict
+from typing import Optional
 from dotenv import load_dotenv
-from jira import JIRA
 from jira.exceptions import JIRAError
 
-load_dotenv()
+import debug_files
+import http_client
+import jira_issue_cache
+import prompts
+import run_metrics
+import sync_ledger
+import toggl
+from toggl import TogglEntry
 
-jira = JIRA(
-    'https://ipsos-cx.atlassian.net/',
-    basic_auth=(os.getenv('jira_user_email'), os.getenv('jira_api_token'))
-)
+load_dotenv()
 
 user_id = os.getenv('jira_user_id')
 
-tempo_api_url = 'https://api.tempo.io/4'
-tempo_token = os.getenv('tempo_api_token')
-
-auth_headers = {
-    'Authorization': f'Bearer {tempo_token}'
-}
-
-issues = {}
+tempo_api_url = http_client.TEMPO_API_URL
 
 issue_key_replacements = {}
 
 WORKLOG_ATTRIBUTE_KEY = '_TOGGL_IMPORTED_'
 WORKLOG_ATTRIBUTE_NAME = 'Toggl imported'
 
+TEMPO_POST_CONCURRENCY = int(os.getenv('tempo_post_concurrency', '8'))
+TEMPO_POST_RETRIES = int(os.getenv('tempo_post_retries', '3'))
+TEMPO_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 def load_toggl_entries():
-    with io.open('debug/toggl-parsed.json', 'r') as f:
-        return json.load(f)
+    return toggl.read_entries()
 
 
+@run_metrics.stage('tempo_attribute')
 def create_worklog_attribute():
-    response = requests.get(
+    tempo = http_client.get_tempo_session()
+
+    response = tempo.get(
         f'{tempo_api_url}/work-attributes',
-        headers=auth_headers,
         params={
             'key': WORKLOG_ATTRIBUTE_KEY,
         }
@@ -50,9 +54,8 @@ def create_worklog_attribute():
     if len(existing_attribute['results']) > 0:
         return
 
-    requests.post(
+    tempo.post(
         f'{tempo_api_url}/work-attributes',
-        headers=auth_headers,
         json={
             'key': WORKLOG_ATTRIBUTE_KEY,
             'name': WORKLOG_ATTRIBUTE_NAME,
@@ -67,63 +70,514 @@ def get_issue_id(issue_key: str) -> int:
     if issue_key in issue_key_replacements:
         issue_key = issue_key_replacements[issue_key]
 
-    if issue_key not in issues:
-        old_issue_key = issue_key
-        while True:
-            try:
-                issue = jira.issue(issue_key)
-                issues[issue_key] = int(issue.id)
-                issues[issue.key] = int(issue.id)
-                break
-            except JIRAError as error:
+    old_issue_key = issue_key
+    while True:
+        try:
+            return jira_issue_cache.get_issue(http_client.get_jira_client(), issue_key).id
+        except JIRAError as error:
+            with prompts.prompt_lock:
+                # entries of the same issue are resolved concurrently, one of them may have been answered meanwhile
+                replacement = issue_key_replacements.get(old_issue_key)
+                if replacement is not None and replacement != issue_key:
+                    issue_key = replacement
+                    continue
+
                 print(error.text)
                 print('Issue with issue key %s does not exist' % issue_key)
-                issue_key = input('Enter issue key manually: ')
+                issue_key = prompts.ask('Enter issue key manually: ')
                 issue_key_replacements[old_issue_key] = issue_key
 
-    return issues[issue_key]
 
+def create_post_data(entry: TogglEntry) -> dict:
+    start_date = entry.date
+    description = entry.description
 
-def import_to_jira():
-    print('Starting JIRA import')
+    if description is None:
+        description = ''
 
-    data = load_toggl_entries()
-
-    for entry in data:
-        tag = entry['tag']
-        start_date = parser.parse(entry['date'])
-        minutes = entry['minutes']
-        description = entry['description']
-
-        if description is None:
-            description = ''
-
-        print('Posting [%s] - %s - %s' % (start_date.strftime('%Y-%m-%d %H:%M:%S'), tag, description))
-
-        post_data = {
-            'authorAccountId': user_id,
-            'description': description,
-            'issueId': get_issue_id(tag),
-            'timeSpentSeconds': minutes * 60,
-            'startDate': start_date.strftime('%Y-%m-%d'),
-            'startTime': start_date.strftime('%H:%M:%S'),
-            # 'attributes': [
-            #     {
-            #         'key': '_WORKLOG_CREATOR_',
-            #         'value': 'toggl_sync'
-            #     }
-            # ]
-        }
+    with run_metrics.stage('issue_resolution'):
+        issue_id = get_issue_id(entry.tag)
+
+    return {
+        'authorAccountId': user_id,
+        'description': description,
+        'issueId': issue_id,
+        'timeSpentSeconds': entry.minutes * 60,
+        'startDate': start_date.strftime('%Y-%m-%d'),
+        'startTime': start_date.strftime('%H:%M:%S'),
+        'attributes': [
+            {
+                'key': WORKLOG_ATTRIBUTE_KEY,
+                'value': 'true'
+            }
+        ]
+    }
+
+
+def get_retry_delay(response: aiohttp.ClientResponse, attempt: int) -> float:
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+
+    return float(2 ** attempt)
+
+
+def is_posted_worklog(worklog: dict, post_data: dict) -> bool:
+    return (
+        int(worklog['issue']['id']) == int(post_data['issueId'])
+        and worklog['startDate'] == post_data['startDate']
+        and worklog['startTime'] == post_data['startTime']
+        and worklog['timeSpentSeconds'] == post_data['timeSpentSeconds']
+        and worklog.get('description', '') == post_data['description']
+        and is_toggl_imported(worklog)
+    )
+
+
+async def find_posted_worklog(http: aiohttp.ClientSession, post_data: dict) -> Optional[dict]:
+    url = f'{tempo_api_url}/worklogs/user/{user_id}'
+    params = {'from': post_data['startDate'], 'to': post_data['startDate'], 'limit': 1000}
+
+    while url is not None:
+        async with http.get(url, params=params) as response:
+            response.raise_for_status()
+            page = await response.json()
+
+        for worklog in page['results']:
+            if is_posted_worklog(worklog, post_data):
+                return worklog
+
+        url = page['metadata'].get('next')
+        params = None
+
+    return None
+
+
+async def find_created_worklog(http: aiohttp.ClientSession, post_data: dict, result: dict) -> tuple[bool, Optional[dict]]:
+    try:
+        worklog = await find_posted_worklog(http, post_data)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        # without knowing, the worklog is reported as failed rather than risking a duplicate
+        result['error'] = 'could not check whether the worklog was created: %r' % error
+        return False, None
+
+    if worklog is not None:
+        result['error'] = None
+
+    return True, worklog
+
+
+async def send_worklog(http: aiohttp.ClientSession, method: str, url: str, post_data: dict, result: dict) -> Optional[dict]:
+    maybe_posted = False
+
+    for attempt in range(TEMPO_POST_RETRIES + 1):
+        if maybe_posted:
+            # tempo may have created the worklog before the post failed, posting it again would duplicate it
+            checked, worklog = await find_created_worklog(http, post_data, result)
+
+            if worklog is not None or not checked:
+                return worklog
+
+        result['attempts'] += 1
+        response = None
+
+        if attempt > 0:
+            run_metrics.increment('retries')
+
+        try:
+            async with http.request(method, url, json=post_data) as response:
+                result['statusCode'] = response.status
+
+                if response.status in (200, 201):
+                    result['error'] = None
+                    return await response.json()
+
+                if response.status == 204:
+                    result['error'] = None
+                    return {}
+
+                result['error'] = await response.text()
+
+                if response.status not in TEMPO_RETRY_STATUSES:
+                    return None
+
+                # a throttled request is rejected before tempo processes it
+                maybe_posted = maybe_posted or (method == 'POST' and response.status != 429)
+        except aiohttp.ClientConnectorError as error:
+            # the connection couldn't be opened, the request never reached tempo
+            result['error'] = repr(error)
+            run_metrics.increment('request_errors')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            result['error'] = repr(error)
+            run_metrics.increment('request_errors')
+            maybe_posted = maybe_posted or method == 'POST'
+
+        if attempt < TEMPO_POST_RETRIES:
+            await asyncio.sleep(get_retry_delay(response, attempt))
+
+    if maybe_posted:
+        return (await find_created_worklog(http, post_data, result))[1]
+
+    return None
+
+
+async def post_worklog(
+        http: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        entry: TogglEntry,
+        post_data: dict,
+        worklog_id: Optional[int] = None,
+        planned: bool = False
+) -> dict:
+    toggl_id = entry.id
+    content_hash = sync_ledger.get_content_hash(post_data)
+
+    # a planned entry was already compared with tempo, the worklog the plan matched is used as given,
+    # otherwise the ledger decides whether the entry was synced before
+    if planned:
+        synced_entry = (worklog_id, None) if worklog_id is not None else None
+    else:
+        synced_entry = sync_ledger.get_synced_entry(toggl_id) if toggl_id is not None else None
+
+    result = {
+        'togglId': toggl_id,
+        'sourceIds': entry.source_ids,
+        'tag': entry.tag,
+        'date': entry.date,
+        'minutes': entry.minutes,
+        'description': entry.description,
+        'issueId': post_data['issueId'],
+        'status': 'failed',
+        'statusCode': None,
+        'attempts': 0,
+        'worklogId': synced_entry[0] if synced_entry is not None else None,
+        'error': None,
+    }
+
+    if not planned:
+        if synced_entry is not None and synced_entry[1] == content_hash:
+            result['status'] = 'skipped'
+            run_metrics.cache_lookup('sync_ledger', True)
+            return result
+
+        run_metrics.cache_lookup('sync_ledger', False)
+
+    async with semaphore:
+        with run_metrics.stage('tempo_posting'):
+            worklog = None
+
+            if result['worklogId'] is not None:
+                worklog = await send_worklog(http, 'PUT', f'{tempo_api_url}/worklogs/{result["worklogId"]}', post_data, result)
+                status = 'updated'
+
+                if worklog is None and result['statusCode'] == 404:
+                    # worklog has been deleted in tempo since the last sync, create it again
+                    if toggl_id is not None:
+                        sync_ledger.forget_synced_entry(toggl_id)
+
+                    result['worklogId'] = None
+
+            if result['worklogId'] is None:
+                worklog = await send_worklog(http, 'POST', f'{tempo_api_url}/worklogs', post_data, result)
+                status = 'posted'
+
+    if worklog is None:
+        return result
+
+    result['status'] = status
+    result['worklogId'] = worklog.get('tempoWorklogId')
+
+    if toggl_id is not None and result['worklogId'] is not None:
+        sync_ledger.record_synced_entry(toggl_id, result['worklogId'], content_hash)
+
+    return result
+
+
+def create_tempo_session() -> aiohttp.ClientSession:
+    return http_client.create_async_tempo_session(TEMPO_POST_CONCURRENCY)
+
+
+async def delete_worklog(http: aiohttp.ClientSession, semaphore: asyncio.Semaphore, worklog: dict) -> dict:
+    result = {
+        'togglId': None,
+        'sourceIds': None,
+        'tag': worklog['issueId'],
+        'date': worklog['startDate'],
+        'minutes': worklog['timeSpentSeconds'] // 60,
+        'description': worklog['description'],
+        'issueId': worklog['issueId'],
+        'status': 'failed',
+        'statusCode': None,
+        'attempts': 0,
+        'worklogId': worklog['worklogId'],
+        'error': None,
+    }
+
+    async with semaphore:
+        with run_metrics.stage('tempo_deleting'):
+            response = await send_worklog(http, 'DELETE', f'{tempo_api_url}/worklogs/{worklog["worklogId"]}', None, result)
+
+    if response is not None:
+        result['status'] = 'deleted'
+
+    return result
 
-        response = requests.post(
-            f'{tempo_api_url}/worklogs',
-            headers=auth_headers,
-            json=post_data
+
+async def post_worklogs(
+        worklogs: list[tuple[TogglEntry, dict, Optional[int]]],
+        concurrency: int = TEMPO_POST_CONCURRENCY,
+        stale_worklogs: Optional[list[dict]] = None
+) -> list[dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with create_tempo_session() as http:
+        return await asyncio.gather(
+            *[post_worklog(http, semaphore, entry, post_data, worklog_id, True) for entry, post_data, worklog_id in worklogs],
+            *[delete_worklog(http, semaphore, worklog) for worklog in stale_worklogs or []]
         )
 
-        if response.status_code != 200:
-            print('Error posting: ' + response.text)
+
+def print_import_report(results: list[dict]):
+    failed = [result for result in results if result['status'] == 'failed']
+
+    for result in failed:
+        print('Error posting [%s] - %s - %s (status %s, %d attempts): %s' % (
+            result['date'],
+            result['tag'],
+            result['description'],
+            result['statusCode'],
+            result['attempts'],
+            result['error']
+        ))
+
+    counts = defaultdict(int)
+    for result in results:
+        counts[result['status']] += 1
+
+    print('Processed %d worklogs: %d posted, %d updated, %d deleted, %d unchanged, %d failed' % (
+        len(results),
+        counts['posted'],
+        counts['updated'],
+        counts['deleted'],
+        counts['skipped'],
+        counts['failed']
+    ))
+
+    debug_files.create_debug_directory()
+    with io.open('debug/tempo-import-report.json', 'w') as f:
+        f.write(json.dumps(results, default=str, ensure_ascii=False))
+
+
+def get_existing_worklogs(date_from: str, date_to: str):
+    url = f'{tempo_api_url}/worklogs/user/{user_id}'
+    params = {
+        'from': date_from,
+        'to': date_to,
+        'offset': 0,
+        'limit': 1000,
+    }
+
+    while url is not None:
+        with run_metrics.stage('tempo_existing_worklogs'):
+            response = http_client.get_tempo_session().get(url, params=params)
+            response.raise_for_status()
+
+            page = response.json()
+
+        yield from page['results']
+
+        # the next page link already carries all query parameters
+        url = page['metadata'].get('next')
+        params = None
+
+
+def is_toggl_imported(worklog: dict) -> bool:
+    for attribute in worklog.get('attributes', {}).get('values', []):
+        if attribute['key'] == WORKLOG_ATTRIBUTE_KEY and attribute['value'] == 'true':
+            return True
+
+    return False
+
+
+def get_worklog_key(issue_id: int, start_date: str, start_time: str) -> tuple:
+    return int(issue_id), start_date, start_time
+
+
+def is_worklog_unchanged(worklog: dict, post_data: dict) -> bool:
+    return (
+        worklog['timeSpentSeconds'] == post_data['timeSpentSeconds']
+        and worklog['description'] == post_data['description']
+    )
+
+
+def get_imported_worklogs(index: dict, key: tuple) -> list[dict]:
+    return [worklog for worklog in index.get(key, []) if worklog['togglImported']]
+
+
+def create_import_plan(worklogs: list[tuple[TogglEntry, dict]], existing_worklogs) -> dict:
+    # existing worklogs are indexed by issue, date and start time, the duration is matched inside the bucket
+    index = defaultdict(list)
+    worklog_keys = {}
+    for worklog in existing_worklogs:
+        key = get_worklog_key(worklog['issue']['id'], worklog['startDate'], worklog['startTime'])
+        worklog_keys[worklog['tempoWorklogId']] = key
+        index[key].append({
+            'worklogId': worklog['tempoWorklogId'],
+            'issueId': worklog['issue']['id'],
+            'startDate': worklog['startDate'],
+            'startTime': worklog['startTime'],
+            'timeSpentSeconds': worklog['timeSpentSeconds'],
+            'description': worklog.get('description', ''),
+            'togglImported': is_toggl_imported(worklog),
+        })
+
+    plan = {
+        'create': [],
+        'update': [],
+        'delete': [],
+        'unchanged': [],
+    }
+
+    updates = []
+    for entry, post_data in worklogs:
+        key = get_worklog_key(post_data['issueId'], post_data['startDate'], post_data['startTime'])
+
+        # an entry synced before keeps its worklog, even when its issue, date or start time changed since
+        synced_entry = sync_ledger.get_synced_entry(entry.id) if entry.id is not None else None
+        if synced_entry is not None and synced_entry[0] in worklog_keys:
+            synced_key = worklog_keys[synced_entry[0]]
+            match = next(worklog for worklog in index[synced_key] if worklog['worklogId'] == synced_entry[0])
+            index[synced_key].remove(match)
+
+            if synced_key == key and is_worklog_unchanged(match, post_data):
+                plan['unchanged'].append((entry, post_data, match['worklogId']))
+            else:
+                plan['update'].append((entry, post_data, match['worklogId']))
+
+            continue
+
+        # manually logged work is never matched, only worklogs created by this import are taken over
+        candidates = get_imported_worklogs(index, key)
+
+        if not candidates:
+            plan['create'].append((entry, post_data, None))
+            continue
+
+        match = None
+        for candidate in candidates:
+            if candidate['timeSpentSeconds'] == post_data['timeSpentSeconds']:
+                match = candidate
+                break
+
+        if match is not None and is_worklog_unchanged(match, post_data):
+            index[key].remove(match)
+            plan['unchanged'].append((entry, post_data, match['worklogId']))
+            continue
+
+        updates.append((entry, post_data, key, match))
+
+    # changed entries take an exactly matching worklog first, otherwise any remaining imported one from the same slot
+    for entry, post_data, key, match in updates:
+        candidates = get_imported_worklogs(index, key)
+
+        if match is None or match not in candidates:
+            match = candidates[0] if candidates else None
+
+        if match is None:
+            plan['create'].append((entry, post_data, None))
+            continue
+
+        index[key].remove(match)
+        plan['update'].append((entry, post_data, match['worklogId']))
+
+    # only worklogs created by this import are considered stale, manually logged work is left alone
+    for bucket in index.values():
+        for worklog in bucket:
+            if worklog['togglImported']:
+                plan['delete'].append(worklog)
+
+    return plan
+
+
+def get_worklogs_date_range(worklogs: list[tuple[TogglEntry, dict]]) -> tuple[str, str]:
+    dates = [post_data['startDate'] for entry, post_data in worklogs]
+
+    return min(dates), max(dates)
+
+
+def plan_import(date_from: Optional[str] = None, date_to: Optional[str] = None) -> dict:
+    # issue keys are resolved up front since an unknown key needs user input
+    worklogs = []
+    for entry in load_toggl_entries():
+        worklogs.append((entry, create_post_data(entry)))
+
+    if not worklogs:
+        return {'create': [], 'update': [], 'delete': [], 'unchanged': []}
+
+    if date_from is None or date_to is None:
+        date_from, date_to = get_worklogs_date_range(worklogs)
+
+    print('Fetching existing worklogs between %s and %s' % (date_from, date_to))
+    plan = create_import_plan(worklogs, get_existing_worklogs(date_from, date_to))
+
+    print('Plan: %d to create, %d to update, %d to delete, %d unchanged' % (
+        len(plan['create']),
+        len(plan['update']),
+        len(plan['delete']),
+        len(plan['unchanged'])
+    ))
+
+    debug_files.create_debug_directory()
+    with io.open('debug/tempo-import-plan.json', 'w') as f:
+        f.write(json.dumps(
+            {
+                'from': date_from,
+                'to': date_to,
+                'create': [post_data for entry, post_data, worklog_id in plan['create']],
+                'update': [{**post_data, 'tempoWorklogId': worklog_id} for entry, post_data, worklog_id in plan['update']],
+                'delete': plan['delete'],
+                'unchanged': [worklog_id for entry, post_data, worklog_id in plan['unchanged']],
+            },
+            default=str,
+            ensure_ascii=False
+        ))
+
+    return plan
+
+
+def import_to_jira(concurrency: int = TEMPO_POST_CONCURRENCY, delete_stale: bool = False) -> list[dict]:
+    print('Starting JIRA import')
+
+    create_worklog_attribute()
+    plan = plan_import()
+
+    # the plan reflects what is actually in tempo, so the ledger is brought in line with it
+    for entry, post_data, worklog_id in plan['unchanged']:
+        if entry.id is not None:
+            sync_ledger.record_synced_entry(entry.id, worklog_id, sync_ledger.get_content_hash(post_data))
+
+    # an entry the ledger still counts as synced has lost its worklog in tempo, it is posted again
+    for entry, post_data, worklog_id in plan['create']:
+        synced_entry = sync_ledger.get_synced_entry(entry.id) if entry.id is not None else None
+
+        if synced_entry is not None and synced_entry[1] == sync_ledger.get_content_hash(post_data):
+            sync_ledger.forget_synced_entry(entry.id)
+
+    worklogs = plan['create'] + plan['update']
+    stale_worklogs = plan['delete'] if delete_stale else []
+
+    print('Posting %d worklogs' % len(worklogs))
+    results = asyncio.run(post_worklogs(worklogs, concurrency, stale_worklogs))
+
+    print_import_report(results)
+
+    return results
 
 
 if __name__ == '__main__':
-    import_to_jira()
+    run_metrics.start()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'plan':
+        plan_import(*sys.argv[2:4])
+    else:
+        import_to_jira(delete_stale='--delete-stale' in sys.argv)
@@ -0,0 +1,31 @@
+import threading
+
+# toggl entries are parsed in a producer thread while issues of earlier entries are resolved in others,
+# a question and the messages leading to it are asked while holding this lock, so prompts never interleave
+prompt_lock = threading.Lock()
+
+# set once the run asking the questions has failed, no new question is asked from then on
+_cancelled = threading.Event()
+
+
+class PromptCancelled(Exception):
+    pass
+
+
+def ask(question: str) -> str:
+    if _cancelled.is_set():
+        raise PromptCancelled(question)
+
+    return input(question)
+
+
+def cancel():
+    _cancelled.set()
+
+    # a question already asked can't be taken back, the run exits once it is answered
+    if prompt_lock.locked():
+        print('\nThe run failed, press Enter to exit.')
+
+
+def reset():
+    _cancelled.clear()
@@ -0,0 +1,245 @@
+import atexit
+import contextvars
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+import http_client
+
+load_dotenv()
+
+SUMMARY_PATH = os.getenv('run_summary_path', 'debug/run-summary.json')
+
+# chrome trace event format, can be opened in https://ui.perfetto.dev or chrome://tracing
+TRACE_PATH = os.getenv('run_trace_path')
+
+# requests made outside of any stage are reported under this name
+UNASSIGNED_STAGE = 'other'
+
+_current_stage = contextvars.ContextVar('run_metrics_stage', default=UNASSIGNED_STAGE)
+_lock = threading.Lock()
+_stages = {}
+_caches = defaultdict(lambda: {'hits': 0, 'misses': 0})
+_trace_events = []
+_origin = time.perf_counter()
+_started_at = None
+_listening = False
+
+
+def create_stage_metrics() -> dict:
+    return {
+        'calls': 0,
+        'busy_seconds': 0.0,
+        'first_started': None,
+        'last_finished': None,
+        'requests': 0,
+        'http_seconds': 0.0,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'statuses': defaultdict(int),
+        'counters': defaultdict(int),
+    }
+
+
+def get_stage_metrics(name: str) -> dict:
+    # callers hold the lock
+    metrics = _stages.get(name)
+
+    if metrics is None:
+        metrics = _stages[name] = create_stage_metrics()
+
+    return metrics
+
+
+def add_trace_event(name: str, category: str, started: float, seconds: float, args: Optional[dict] = None):
+    if TRACE_PATH:
+        _trace_events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((started - _origin) * 1000000),
+            'dur': round(seconds * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args or {},
+        })
+
+
+@contextmanager
+def stage(name: str):
+    # the stage is kept in a context variable, so it follows asyncio tasks and asyncio.to_thread calls
+    token = _current_stage.set(name)
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        finished = time.perf_counter()
+        _current_stage.reset(token)
+
+        with _lock:
+            metrics = get_stage_metrics(name)
+            metrics['calls'] += 1
+            metrics['busy_seconds'] += finished - started
+
+            if metrics['first_started'] is None:
+                metrics['first_started'] = started
+            metrics['last_finished'] = finished
+
+            add_trace_event(name, 'stage', started, finished - started)
+
+
+def increment(counter: str, value: int = 1):
+    with _lock:
+        get_stage_metrics(_current_stage.get())['counters'][counter] += value
+
+
+def cache_lookup(cache: str, hit: bool):
+    with _lock:
+        _caches[cache]['hits' if hit else 'misses'] += 1
+        get_stage_metrics(_current_stage.get())['counters']['cache_hits' if hit else 'cache_misses'] += 1
+
+
+def get_header(headers: dict, name: str) -> Optional[str]:
+    for header, value in headers.items():
+        if header.lower() == name:
+            return value
+
+    return None
+
+
+def record_exchange(exchange: dict):
+    finished = time.perf_counter()
+    request_body = exchange['request_body']
+
+    # compressed responses are counted by their transferred size when the server reports it
+    content_length = get_header(exchange['headers'], 'content-length')
+    received = int(content_length) if content_length and content_length.isdigit() else len(exchange['body'] or b'')
+
+    with _lock:
+        metrics = get_stage_metrics(_current_stage.get())
+        metrics['requests'] += 1
+        metrics['http_seconds'] += exchange['elapsed']
+        metrics['bytes_sent'] += len(request_body.encode('utf-8')) if request_body else 0
+        metrics['bytes_received'] += received
+        metrics['statuses'][str(exchange['status'])] += 1
+
+        url = urlsplit(exchange['url'])
+        add_trace_event(
+            '%s %s%s' % (exchange['method'], url.netloc, url.path),
+            'http',
+            finished - exchange['elapsed'],
+            exchange['elapsed'],
+            {'status': exchange['status'], 'stage': _current_stage.get()}
+        )
+
+
+def reset():
+    # a process running for several users starts every run from empty metrics
+    global _started_at
+
+    with _lock:
+        _stages.clear()
+        _caches.clear()
+        _trace_events.clear()
+        _started_at = None
+
+
+def start(write_at_exit: bool = True):
+    global _started_at, _listening
+
+    _started_at = time.time()
+
+    if not _listening:
+        _listening = True
+        http_client.add_response_listener(record_exchange)
+
+    if write_at_exit:
+        atexit.register(write_summary)
+
+
+def get_summary() -> dict:
+    with _lock:
+        stages = {}
+
+        for name, metrics in _stages.items():
+            stages[name] = {
+                'calls': metrics['calls'],
+                # stages run concurrently, busy time adds up every call while wall time spans first to last call
+                'wall_seconds': round(metrics['last_finished'] - metrics['first_started'], 4)
+                if metrics['first_started'] is not None else 0.0,
+                'busy_seconds': round(metrics['busy_seconds'], 4),
+                'requests': metrics['requests'],
+                'http_seconds': round(metrics['http_seconds'], 4),
+                'bytes_sent': metrics['bytes_sent'],
+                'bytes_received': metrics['bytes_received'],
+                'statuses': dict(metrics['statuses']),
+                'counters': dict(metrics['counters']),
+            }
+
+        caches = {
+            name: {**counts, 'hit_ratio': round(counts['hits'] / (counts['hits'] + counts['misses']), 4)}
+            for name, counts in _caches.items()
+            if counts['hits'] + counts['misses']
+        }
+
+    return {
+        'command': sys.argv,
+        'started_at': datetime.fromtimestamp(_started_at).isoformat() if _started_at else None,
+        'seconds': round(time.time() - _started_at, 4) if _started_at else None,
+        'requests': sum(stage_summary['requests'] for stage_summary in stages.values()),
+        'bytes_sent': sum(stage_summary['bytes_sent'] for stage_summary in stages.values()),
+        'bytes_received': sum(stage_summary['bytes_received'] for stage_summary in stages.values()),
+        'stages': stages,
+        'caches': caches,
+    }
+
+
+def print_summary(summary: dict):
+    print('%-26s %8s %9s %9s %9s %11s' % ('stage', 'calls', 'wall', 'busy', 'requests', 'received'))
+
+    for name, stage_summary in summary['stages'].items():
+        if not stage_summary['calls'] and not stage_summary['requests']:
+            continue
+
+        print('%-26s %8d %7.2f s %7.2f s %9d %8.1f kB' % (
+            name,
+            stage_summary['calls'],
+            stage_summary['wall_seconds'],
+            stage_summary['busy_seconds'],
+            stage_summary['requests'],
+            stage_summary['bytes_received'] / 1024
+        ))
+
+    for name, counts in summary['caches'].items():
+        print('%s cache: %d hits, %d misses (%.0f %%)' % (name, counts['hits'], counts['misses'], counts['hit_ratio'] * 100))
+
+
+def write_summary(path: str = SUMMARY_PATH) -> dict:
+    summary = get_summary()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with io.open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    if TRACE_PATH:
+        with _lock, io.open(TRACE_PATH, 'w') as f:
+            json.dump({'traceEvents': _trace_events, 'displayTimeUnit': 'ms'}, f)
+
+    print_summary(summary)
+    print('Run summary written to %s' % path)
+
+    return summary
@@ -1,9 +1,6 @@
 import enquiries
 import pendulum
 
-import jira_sync
-import toggl
-
 pendulum.week_starts_at(pendulum.MONDAY)
 
 
@@ -55,5 +52,15 @@ if __name__ == '__main__':
 
     print('Syncing data from {} to {}'.format(start, end))
 
-    toggl.import_entries(start, end)
-    jira_sync.import_to_jira()
+    # the pipeline loads the HTTP and Jira clients, so it is only imported once a period has been chosen
+    import asyncio
+    import jira_sync
+    import run_metrics
+    import sync_pipeline
+
+    run_metrics.start()
+
+    print('Starting JIRA import')
+    jira_sync.create_worklog_attribute()
+    results = asyncio.run(sync_pipeline.sync_period(start, end))
+    jira_sync.print_import_report(results)
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LEDGER_PATH = os.getenv('toggl_sync_ledger_path', 'debug/toggl-sync-ledger.sqlite')
+
+_connection = None
+_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+
+    if _connection is None:
+        directory = os.path.dirname(LEDGER_PATH)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        _connection = sqlite3.connect(LEDGER_PATH, check_same_thread=False, isolation_level=None)
+        _connection.execute('''
+            CREATE TABLE IF NOT EXISTS synced_entries (
+                toggl_id INTEGER PRIMARY KEY,
+                worklog_id INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            )
+        ''')
+
+    return _connection
+
+
+def get_content_hash(post_data: dict) -> str:
+    return hashlib.sha1(json.dumps(post_data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def get_synced_entry(toggl_id: int) -> Optional[Tuple[int, str]]:
+    with _lock:
+        row = get_connection().execute(
+            'SELECT worklog_id, content_hash FROM synced_entries WHERE toggl_id = ?',
+            (toggl_id,)
+        ).fetchone()
+
+    return (row[0], row[1]) if row is not None else None
+
+
+def record_synced_entry(toggl_id: int, worklog_id: int, content_hash: str):
+    with _lock:
+        get_connection().execute(
+            'INSERT OR REPLACE INTO synced_entries (toggl_id, worklog_id, content_hash, synced_at) VALUES (?, ?, ?, ?)',
+            (toggl_id, worklog_id, content_hash, time.time())
+        )
+
+
+def forget_synced_entry(toggl_id: int):
+    with _lock:
+        get_connection().execute('DELETE FROM synced_entries WHERE toggl_id = ?', (toggl_id,))
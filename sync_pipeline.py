@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from typing import Optional
+
+import jira_sync
+import prompts
+import toggl
+
+# bounds the number of entries buffered between two pipeline stages
+STAGE_QUEUE_SIZE = 100
+
+
+async def produce_entries(start_date: str, end_date: str, parsed_queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+
+    def produce():
+        count = 0
+
+        for entry in toggl.iter_entries(start_date, end_date):
+            if cancelled.is_set():
+                return
+
+            asyncio.run_coroutine_threadsafe(parsed_queue.put(entry), loop).result()
+            count += 1
+
+        print('Successfully imported {} entries'.format(count))
+
+    try:
+        await asyncio.to_thread(produce)
+    except asyncio.CancelledError:
+        # another stage failed, unblock the producer thread so the run can exit
+        cancelled.set()
+        while not parsed_queue.empty():
+            parsed_queue.get_nowait()
+        raise
+
+    await parsed_queue.put(None)
+
+
+async def resolve_entries(parsed_queue: asyncio.Queue, resolved_queue: asyncio.Queue):
+    # issues are resolved one at a time, an unknown issue key falls back to user input
+    while (entry := await parsed_queue.get()) is not None:
+        post_data = await asyncio.to_thread(jira_sync.create_post_data, entry)
+        await resolved_queue.put((entry, post_data))
+
+    await resolved_queue.put(None)
+
+
+async def post_entries(resolved_queue: asyncio.Queue, concurrency: int) -> list[dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+
+    async with jira_sync.create_tempo_session() as http:
+        while (item := await resolved_queue.get()) is not None:
+            entry, post_data = item
+            tasks.append(asyncio.create_task(jira_sync.post_worklog(http, semaphore, entry, post_data)))
+
+        return list(await asyncio.gather(*tasks))
+
+
+async def sync_period(start_date: str, end_date: str, concurrency: Optional[int] = None) -> list[dict]:
+    if concurrency is None:
+        concurrency = jira_sync.TEMPO_POST_CONCURRENCY
+
+    parsed_queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+    resolved_queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+
+    prompts.reset()
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(produce_entries(start_date, end_date, parsed_queue))
+            group.create_task(resolve_entries(parsed_queue, resolved_queue))
+            posting = group.create_task(post_entries(resolved_queue, concurrency))
+    except BaseException:
+        # the stage threads can't be stopped, they only finish after the question they wait on is answered
+        prompts.cancel()
+        raise
+
+    return posting.result()
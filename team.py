@@ -0,0 +1,234 @@
+import asyncio
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEAM_DIR = os.path.join(PROJECT_DIR, 'team')
+ROSTER_PATH = os.path.join(PROJECT_DIR, 'team.json')
+
+# files every user directory needs, copied from the project directory unless the user has their own
+SHARED_FILES = ['jira_itime_task_mapping.json']
+
+# credentials are always taken from the roster, never from the local .env
+PROFILE_KEYS = [
+    'toggl_api_token',
+    'tempo_api_token',
+    'jira_api_token',
+    'jira_user_email',
+    'jira_user_id',
+    'itime_username',
+    'itime_password_base_64',
+]
+
+DEFAULT_WORKERS = 4
+
+TASKS = ['sync', 'itime']
+
+# names become directory names under TEAM_DIR
+USER_NAME_REGEX = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+# modules which read the user's settings or keep the user's state at module level, in dependency order,
+# they are reloaded for every user a worker runs, libraries and pooled sessions stay loaded
+USER_MODULES = [
+    'sync_ledger',
+    'jira_issue_cache',
+    'jira_search',
+    'tempo_accounts',
+    'toggl',
+    'jira_sync',
+    'sync_pipeline',
+    'itime',
+]
+
+
+def load_roster(path: str = ROSTER_PATH) -> dict:
+    with io.open(path, 'r') as f:
+        roster = json.load(f)
+
+    names = [profile['name'] for profile in roster['users']]
+    for name in names:
+        if not isinstance(name, str) or not USER_NAME_REGEX.match(name):
+            raise ValueError('user name %r in %s can only contain letters, digits, ".", "_" and "-"' % (name, path))
+
+    if len(names) != len(set(names)):
+        raise ValueError('user names in %s must be unique' % path)
+
+    return roster
+
+
+def prepare_user_directory(name: str) -> str:
+    directory = os.path.join(TEAM_DIR, name)
+
+    if not os.path.exists(os.path.join(directory, 'debug')):
+        os.makedirs(os.path.join(directory, 'debug'))
+
+    for file_name in SHARED_FILES:
+        if not os.path.exists(os.path.join(directory, file_name)):
+            shutil.copy(os.path.join(PROJECT_DIR, file_name), os.path.join(directory, file_name))
+
+    return directory
+
+
+def run_sync(start_date: str, end_date: str) -> dict:
+    import jira_sync
+    import sync_pipeline
+
+    jira_sync.create_worklog_attribute()
+    results = asyncio.run(sync_pipeline.sync_period(start_date, end_date))
+    jira_sync.print_import_report(results)
+
+    counts = defaultdict(int)
+    for result in results:
+        counts[result['status']] += 1
+
+    return dict(counts)
+
+
+def run_itime() -> dict:
+    import itime
+
+    itime.itime_login()
+    itime.load_jira_account_itime_mapping()
+    itime.check_jira_itime_task_mapping()
+
+    try:
+        submitted = itime.process_catch_up(confirm=False)
+    finally:
+        itime.save_jira_account_mapping()
+
+    return {'submitted_weeks': submitted}
+
+
+def load_user_modules():
+    for name in USER_MODULES:
+        if name in sys.modules:
+            importlib.reload(sys.modules[name])
+
+
+def run_user(profile: dict, shared_env: dict, tasks: list[str], start_date: str, end_date: str) -> dict:
+    # workers are reused for several users, http sessions are pooled per credentials and the modules
+    # keeping user state are reloaded, the environment is restored once the user is done
+    started = time.perf_counter()
+    directory = prepare_user_directory(profile['name'])
+    saved_environ = dict(os.environ)
+
+    env = {**shared_env, **profile.get('env', {})}
+    for key in PROFILE_KEYS:
+        os.environ[key] = env.get(key, '')
+
+    os.environ.update(env)
+    os.environ.setdefault('jira_issue_cache_path', os.path.join(TEAM_DIR, 'jira-issue-cache.sqlite'))
+
+    os.chdir(directory)
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+
+    try:
+        return run_user_tasks(profile, tasks, start_date, end_date, directory, started)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+
+def run_user_tasks(profile: dict, tasks: list[str], start_date: str, end_date: str, directory: str, started: float) -> dict:
+    import run_metrics
+
+    load_user_modules()
+
+    # worker processes exit without running exit handlers, the summary is written explicitly
+    run_metrics.reset()
+    run_metrics.start(write_at_exit=False)
+
+    report = {
+        'name': profile['name'],
+        'status': 'ok',
+        'tasks': {},
+        'error': None,
+        'log': os.path.join(directory, 'team-run.log'),
+    }
+
+    with io.open('team-run.log', 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            for task in tasks:
+                if task == 'sync':
+                    report['tasks'][task] = run_sync(start_date, end_date)
+                elif task == 'itime':
+                    report['tasks'][task] = run_itime()
+        except (Exception, SystemExit) as error:
+            traceback.print_exc()
+            report['status'] = 'failed'
+            report['error'] = repr(error)
+
+        summary = run_metrics.write_summary()
+
+    report['seconds'] = round(time.perf_counter() - started, 2)
+    report['requests'] = summary['requests']
+    report['summary'] = os.path.join(directory, run_metrics.SUMMARY_PATH)
+
+    return report
+
+
+def run_team(tasks: list[str], start_date: str = None, end_date: str = None, roster_path: str = ROSTER_PATH) -> list[dict]:
+    roster = load_roster(roster_path)
+    os.makedirs(TEAM_DIR, exist_ok=True)
+    workers = int(roster.get('workers', DEFAULT_WORKERS))
+
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_user, profile, roster.get('env', {}), tasks, start_date, end_date): profile['name']
+            for profile in roster['users']
+            if not profile.get('tasks') or set(tasks) & set(profile['tasks'])
+        }
+
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as error:
+                report = {'name': futures[future], 'status': 'failed', 'tasks': {}, 'error': repr(error)}
+
+            print('[%s] %s %s' % (report['name'], report['status'], report['error'] or report['tasks']))
+            reports.append(report)
+
+    reports.sort(key=lambda x: x['name'])
+
+    with io.open(os.path.join(TEAM_DIR, 'team-report.json'), 'w') as f:
+        json.dump(reports, f, indent=2)
+
+    failed = [report for report in reports if report['status'] != 'ok']
+    print('Finished %d users, %d failed' % (len(reports), len(failed)))
+
+    for report in failed:
+        print('  %s: %s (see %s)' % (report['name'], report['error'], report.get('log')))
+
+    return reports
+
+
+def print_usage():
+    print('Usage: python team.py sync YYYY-MM-DD YYYY-MM-DD')
+    print('       python team.py itime')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in TASKS:
+        print_usage()
+        exit(1)
+
+    if sys.argv[1] == 'sync':
+        if len(sys.argv) != 4:
+            print_usage()
+            exit(1)
+
+        run_team(['sync'], sys.argv[2], sys.argv[3])
+    else:
+        run_team(['itime'])
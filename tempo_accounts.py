@@ -0,0 +1,171 @@
+import io
+import json
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+from dotenv import load_dotenv
+
+import http_client
+import run_metrics
+
+load_dotenv()
+
+DIRECTORY_PATH = os.getenv('tempo_accounts_path', 'debug/tempo-accounts.json')
+DIRECTORY_TTL_SECONDS = int(os.getenv('tempo_accounts_ttl', str(24 * 60 * 60)))
+
+PAGE_LIMIT = 1000
+
+# only these fields of an account are kept in the directory
+ACCOUNT_FIELDS = ('id', 'key', 'name', 'status')
+
+_accounts = None
+_keys_by_name = {}
+_keys_by_id = {}
+_fetched_at = 0.0
+_refreshed = False
+_lock = threading.RLock()
+
+
+def iter_account_pages(method: str, url: str, body: Optional[dict] = None):
+    params = {'offset': 0, 'limit': PAGE_LIMIT}
+
+    while url is not None:
+        with run_metrics.stage('tempo_accounts'):
+            response = http_client.get_tempo_session().request(method, url, params=params, json=body)
+            response.raise_for_status()
+
+            page = response.json()
+
+        yield page['results']
+
+        # the next page link already carries offset and limit
+        url = page['metadata'].get('next')
+        params = None
+
+
+def fetch_all_accounts() -> list[dict]:
+    accounts = []
+
+    for page in iter_account_pages('GET', f'{http_client.TEMPO_API_URL}/accounts'):
+        accounts.extend(page)
+
+    return accounts
+
+
+def fetch_accounts_by_keys(keys: list[str]) -> list[dict]:
+    accounts = []
+
+    for page in iter_account_pages('POST', f'{http_client.TEMPO_API_URL}/accounts/search', {'keys': keys}):
+        accounts.extend(page)
+
+    return accounts
+
+
+def index_accounts(accounts: Iterable[dict]):
+    for account in accounts:
+        account = {field: account.get(field) for field in ACCOUNT_FIELDS}
+
+        _accounts[account['key']] = account
+        _keys_by_id[account['id']] = account['key']
+
+        if account['name'] is not None:
+            _keys_by_name[account['name'].strip()] = account['key']
+
+
+def save_directory():
+    directory = os.path.dirname(DIRECTORY_PATH)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with io.open(DIRECTORY_PATH, 'w') as f:
+        json.dump({'fetched_at': _fetched_at, 'accounts': list(_accounts.values())}, f)
+
+
+def refresh():
+    global _accounts, _keys_by_name, _keys_by_id, _fetched_at, _refreshed
+
+    with _lock:
+        print('Fetching Tempo accounts...')
+
+        accounts = fetch_all_accounts()
+
+        _accounts, _keys_by_name, _keys_by_id = {}, {}, {}
+        index_accounts(accounts)
+
+        _fetched_at = time.time()
+        _refreshed = True
+        save_directory()
+
+
+def load_directory():
+    global _accounts, _fetched_at
+
+    with _lock:
+        if _accounts is not None:
+            return
+
+        _accounts = {}
+
+        if os.path.exists(DIRECTORY_PATH):
+            with io.open(DIRECTORY_PATH, 'r') as f:
+                stored = json.load(f)
+
+            index_accounts(stored['accounts'])
+            _fetched_at = stored['fetched_at']
+
+        if time.time() - _fetched_at > DIRECTORY_TTL_SECONDS:
+            refresh()
+
+
+def get_accounts(keys: Iterable[str]) -> dict[str, dict]:
+    load_directory()
+    keys = list(dict.fromkeys(keys))
+
+    with _lock:
+        missing = [key for key in keys if key not in _accounts]
+
+        for key in keys:
+            run_metrics.cache_lookup('tempo_accounts', key not in missing)
+
+        # accounts created since the last refresh are fetched on their own and added to the directory
+        if missing:
+            index_accounts(fetch_accounts_by_keys(missing))
+            save_directory()
+
+        return {key: _accounts[key] for key in keys if key in _accounts}
+
+
+def get_account_ids(keys: Iterable[str]) -> dict[str, int]:
+    return {key: account['id'] for key, account in get_accounts(keys).items()}
+
+
+def get_account_key(name: str) -> Optional[str]:
+    load_directory()
+    name = name.strip()
+
+    with _lock:
+        key = _keys_by_name.get(name)
+        run_metrics.cache_lookup('tempo_accounts', key is not None)
+
+        # accounts can't be searched by name, an unknown name refreshes the whole directory once per run
+        if key is None and not _refreshed:
+            refresh()
+            key = _keys_by_name.get(name)
+
+        return key
+
+
+def get_account_key_by_id(account_id: int) -> Optional[str]:
+    load_directory()
+
+    with _lock:
+        key = _keys_by_id.get(account_id)
+        run_metrics.cache_lookup('tempo_accounts', key is not None)
+
+        if key is None and not _refreshed:
+            refresh()
+            key = _keys_by_id.get(account_id)
+
+        return key
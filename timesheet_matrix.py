@@ -0,0 +1,82 @@
+from datetime import date, timedelta
+from typing import Callable, Iterable, Tuple
+
+DAYS_IN_WEEK = 7
+
+RowKey = Tuple[str, str]  # itime project, itime task
+
+
+class WeekMatrix:
+    __slots__ = ('week_start', 'row_indexes', 'row_keys', 'cells')
+
+    def __init__(self, week_start: date):
+        self.week_start = week_start
+        self.row_indexes = {}
+        self.row_keys = []
+        self.cells = []
+
+    def add(self, row_key: RowKey, day_index: int, seconds: int):
+        row_index = self.row_indexes.get(row_key)
+
+        if row_index is None:
+            row_index = len(self.row_keys)
+            self.row_indexes[row_key] = row_index
+            self.row_keys.append(row_key)
+            self.cells.append([0] * DAYS_IN_WEEK)
+
+        self.cells[row_index][day_index] += seconds
+
+    def rows(self):
+        return zip(self.row_keys, self.cells)
+
+    def row_totals(self) -> list[int]:
+        return [sum(row) for row in self.cells]
+
+    def day_totals(self) -> list[int]:
+        totals = [0] * DAYS_IN_WEEK
+
+        for row in self.cells:
+            for day_index in range(DAYS_IN_WEEK):
+                totals[day_index] += row[day_index]
+
+        return totals
+
+    def total(self) -> int:
+        return sum(self.row_totals())
+
+
+def get_day_indexes(week_starts: Iterable[date]) -> dict[str, Tuple[date, int]]:
+    # tempo start dates are looked up as strings, so no date parsing happens per worklog
+    day_indexes = {}
+
+    for week_start in week_starts:
+        for day_index in range(DAYS_IN_WEEK):
+            day_indexes[(week_start + timedelta(days=day_index)).isoformat()] = (week_start, day_index)
+
+    return day_indexes
+
+
+def aggregate_weeks(
+        worklogs: Iterable[Tuple[int, str, int]],
+        week_starts: Iterable[date],
+        get_row_key: Callable[[int], RowKey]
+) -> dict[date, WeekMatrix]:
+    week_starts = list(week_starts)
+    day_indexes = get_day_indexes(week_starts)
+    matrices = {week_start: WeekMatrix(week_start) for week_start in week_starts}
+    row_keys = {}
+
+    for issue_id, start_date, seconds in worklogs:
+        day = day_indexes.get(start_date)
+
+        if day is None:
+            continue
+
+        row_key = row_keys.get(issue_id)
+        if row_key is None:
+            row_key = row_keys[issue_id] = get_row_key(issue_id)
+
+        week_start, day_index = day
+        matrices[week_start].add(row_key, day_index, seconds)
+
+    return matrices
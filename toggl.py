@@ -1,15 +1,78 @@
+import csv
 import json
 import os
 
-import requests
 import io
 import re
-from base64 import b64encode
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo
 from dateutil import parser
 from dotenv import load_dotenv
 
+import http_client
+import prompts
+import run_metrics
+
 load_dotenv()
 
+toggl_time_entries_url = http_client.TOGGL_API_URL + '/me/time_entries'
+toggl_me_url = http_client.TOGGL_API_URL + '/me'
+toggl_report_export_url = http_client.TOGGL_REPORTS_URL + '/workspace/{}/search/time_entries.csv'
+
+# the range is split into windows which are fetched concurrently, this keeps each response small
+# and avoids the API limits which would otherwise silently truncate long ranges
+TOGGL_WINDOW_DAYS = int(os.getenv('toggl_window_days', '7'))
+TOGGL_FETCH_WORKERS = int(os.getenv('toggl_fetch_workers', '4'))
+
+# backfills read the detailed report export of a workspace, a single request covers up to a year
+TOGGL_WORKSPACE_ID = os.getenv('toggl_workspace_id')
+TOGGL_REPORT_WINDOW_DAYS = 365
+
+TOGGL_DATE_FORMAT = '%Y-%m-%d'
+TOGGL_REPORT_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+TOGGL_ENTRIES_PATH = 'debug/toggl-parsed.jsonl'
+
+# entries of the same issue and day can be merged before rounding, so short entries aren't each rounded up
+# 'none' keeps every entry, 'description' merges entries with the same description, 'tag' merges all of them
+COALESCE_POLICIES = ('none', 'description', 'tag')
+COALESCE_POLICY = os.getenv('toggl_coalesce', 'none')
+COALESCED_DESCRIPTION_SEPARATOR = '; '
+
+issue_pattern = re.compile(r'^(?:#\d+\s+)?(?:([a-z]+-\d+)|(?:\[([a-z]+-\d+)])|(?:hotfix|feature)(?:\s+-\s+|/)([a-z]+[- ]\d+))(\D.*)?',
+                           re.IGNORECASE)
+tag_pattern = re.compile(r'^\w+-\d+$')
+
+
+@dataclass(slots=True)
+class TogglEntry:
+    id: Optional[int]
+    tag: str
+    start: int  # unix timestamp
+    utc_offset: int  # seconds, keeps the timezone toggl reported the entry in
+    minutes: int
+    description: Optional[str]
+    source_ids: Optional[list[int]] = None  # toggl entries merged into this one
+
+    @property
+    def date(self) -> datetime:
+        return datetime.fromtimestamp(self.start, timezone(timedelta(seconds=self.utc_offset)))
+
+    def to_line(self) -> str:
+        return json.dumps(
+            [self.id, self.tag, self.start, self.utc_offset, self.minutes, self.description, self.source_ids],
+            ensure_ascii=False
+        ) + '\n'
+
+    @staticmethod
+    def from_line(line: str) -> 'TogglEntry':
+        return TogglEntry(*json.loads(line))
+
 
 def round_minutes(v_minutes: int) -> int:
     if 15 > v_minutes > 2:
@@ -24,95 +87,293 @@ def round_minutes(v_minutes: int) -> int:
     return floored
 
 
-def import_entries(start_date: str, end_date: str):
-    print('Starting import of entries from toggl between {} and {}'.format(start_date, end_date))
-    issue_pattern = re.compile(r'^(?:#\d+\s+)?(?:([a-z]+-\d+)|(?:\[([a-z]+-\d+)])|(?:hotfix|feature)(?:\s+-\s+|/)([a-z]+[- ]\d+))(\D.*)?',
-                               re.IGNORECASE)
-    tag_pattern = re.compile(r'^\w+-\d+$')
-
-    api_token = os.getenv('toggl_api_token')
-
-    response = requests.get(
-        'https://api.track.toggl.com/api/v9/me/time_entries',
-        headers={
-            'content-type': 'application/json',
-            'Authorization': 'Basic %s' % b64encode(f"{api_token}:api_token".encode('ascii')).decode("ascii")
-        },
-        params={
-            'start_date': start_date,
-            'end_date': end_date
-        }
-    )
+def split_date_range(start_date: str, end_date: str, window_days: int = TOGGL_WINDOW_DAYS):
+    window_start = datetime.strptime(start_date, TOGGL_DATE_FORMAT)
+    range_end = datetime.strptime(end_date, TOGGL_DATE_FORMAT)
 
-    data = response.json()
+    while window_start < range_end:
+        window_end = min(window_start + timedelta(days=window_days), range_end)
+
+        yield window_start.strftime(TOGGL_DATE_FORMAT), window_end.strftime(TOGGL_DATE_FORMAT)
+
+        window_start = window_end
 
-    entries = []
-    for entry in data:
-        try:
-            if entry['stop'] is None:  # timer is currently still running
-                continue
 
-            match = issue_pattern.match(entry['description'])
+def fetch_time_entries(start_date: str, end_date: str) -> list[dict]:
+    with run_metrics.stage('toggl_fetch'):
+        response = http_client.get_toggl_session().get(
+            toggl_time_entries_url,
+            params={
+                'start_date': start_date,
+                'end_date': end_date
+            }
+        )
+        response.raise_for_status()
 
-            if match is None:
-                print(f"Could not match issue tag for description: '{entry['description']}' logged: {entry['start']}")
-                tag = input('Enter tag manually: ')
-                description = input('Enter tag description: ')
-            else:
-                tag = match.group(1)
+        entries = response.json()
+    entries.sort(key=lambda x: x['start'])
 
-                if tag is None:
-                    tag = match.group(2)
+    return entries
 
-                if tag is None:
-                    tag = match.group(3)
 
-                description = match.group(4)
+def iter_windows(start_date: str, end_date: str):
+    with ThreadPoolExecutor(max_workers=TOGGL_FETCH_WORKERS) as executor:
+        pending = deque()
 
-            if ' ' in tag:
-                tag = tag.replace(' ', '-')
+        # only a bounded number of windows is in flight, windows are yielded in chronological order
+        for window in split_date_range(start_date, end_date):
+            pending.append(executor.submit(fetch_time_entries, *window))
 
-            if tag_pattern.match(tag) is None:
-                print(f"Could not match issue tag for description: '{entry['description']}' logged: {entry['start']}")
-                tag = input('Enter tag manually: ')
-                description = input('Enter tag description: ')
+            if len(pending) >= TOGGL_FETCH_WORKERS:
+                yield pending.popleft().result()
 
-            start = parser.isoparse(entry['start'])
-            stop = parser.isoparse(entry['stop'])
+        while pending:
+            yield pending.popleft().result()
 
-            if start.date() != stop.date():
-                raise ValueError(f"Invalid date range - {entry['start']} - {entry['stop']}")
 
-            minutes = int((stop - start).total_seconds() / 60)
-            minutes = round_minutes(minutes)
+def iter_time_entries(start_date: str, end_date: str):
+    seen_ids = set()
 
-            if minutes == 0:
+    for window_entries in iter_windows(start_date, end_date):
+        for entry in window_entries:
+            if entry['id'] in seen_ids:
                 continue
 
-            if description is not None:
-                description = description.strip()
+            seen_ids.add(entry['id'])
+            yield entry
+
+
+def get_me() -> dict:
+    response = http_client.get_toggl_session().get(toggl_me_url)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def iter_report_rows(workspace_id: int, user_id: int, start_date: str, end_date: str):
+    with run_metrics.stage('toggl_export'):
+        response = http_client.get_toggl_session().post(
+            toggl_report_export_url.format(workspace_id),
+            json={
+                'start_date': start_date,
+                'end_date': end_date,
+                'user_ids': [user_id],
+                'order_by': 'date',
+                'order_dir': 'ASC',
+            },
+            stream=True
+        )
+        response.raise_for_status()
+
+    # rows are parsed while they are downloaded, the export is never held in memory
+    response.raw.decode_content = True
+    response.raw.auto_close = False
+
+    with response, io.TextIOWrapper(response.raw, encoding='utf-8-sig', newline='') as stream:
+        yield from csv.DictReader(stream)
+
+
+def report_row_to_entry(row: dict, time_zone: ZoneInfo) -> dict:
+    # the export has no entry ids and reports times in the timezone of the user's profile
+    start = datetime.strptime(f"{row['Start date']} {row['Start time']}", TOGGL_REPORT_DATETIME_FORMAT)
+    stop = datetime.strptime(f"{row['End date']} {row['End time']}", TOGGL_REPORT_DATETIME_FORMAT)
+
+    return {
+        'id': None,
+        'description': row['Description'],
+        'start': start.replace(tzinfo=time_zone).isoformat(),
+        'stop': stop.replace(tzinfo=time_zone).isoformat(),
+    }
+
+
+def iter_report_entries(start_date: str, end_date: str):
+    me = get_me()
+    workspace_id = TOGGL_WORKSPACE_ID or me['default_workspace_id']
+    time_zone = ZoneInfo(me['timezone'])
+
+    for window_start, window_end in split_date_range(start_date, end_date, TOGGL_REPORT_WINDOW_DAYS):
+        # the report includes its end date, the imported range doesn't
+        last_day = (datetime.strptime(window_end, TOGGL_DATE_FORMAT) - timedelta(days=1)).strftime(TOGGL_DATE_FORMAT)
+
+        for row in iter_report_rows(workspace_id, me['id'], window_start, last_day):
+            yield report_row_to_entry(row, time_zone)
+
+
+def ask_for_tag(entry: dict) -> Tuple[str, str]:
+    with prompts.prompt_lock:
+        print(f"Could not match issue tag for description: '{entry['description']}' logged: {entry['start']}")
+        tag = prompts.ask('Enter tag manually: ')
+        description = prompts.ask('Enter tag description: ')
+
+    return tag, description
+
+
+def parse_entry(entry: dict, rounded: bool = True) -> Optional[TogglEntry]:
+    if entry['stop'] is None:  # timer is currently still running
+        return None
+
+    match = issue_pattern.match(entry['description'])
+
+    if match is None:
+        tag, description = ask_for_tag(entry)
+    else:
+        tag = match.group(1)
+
+        if tag is None:
+            tag = match.group(2)
+
+        if tag is None:
+            tag = match.group(3)
 
-            entries.append({
-                'tag': tag,
-                'date': start,
-                'minutes': minutes,
-                'description': description
-            })
+        description = match.group(4)
+
+    if ' ' in tag:
+        tag = tag.replace(' ', '-')
+
+    if tag_pattern.match(tag) is None:
+        tag, description = ask_for_tag(entry)
+
+    start = parser.isoparse(entry['start'])
+    stop = parser.isoparse(entry['stop'])
+
+    if start.date() != stop.date():
+        raise ValueError(f"Invalid date range - {entry['start']} - {entry['stop']}")
+
+    if rounded:
+        minutes = round_minutes(int((stop - start).total_seconds() / 60))
+    else:
+        # merged entries are rounded once their total is known
+        minutes = round((stop - start).total_seconds() / 60)
+
+    if minutes == 0:
+        return None
+
+    if description is not None:
+        description = description.strip()
+
+    return TogglEntry(
+        entry['id'],
+        tag,
+        int(start.timestamp()),
+        int(start.utcoffset().total_seconds()),
+        minutes,
+        description
+    )
+
+
+def get_coalesce_key(entry: TogglEntry, policy: str) -> tuple:
+    if policy == 'tag':
+        return entry.tag.upper(), entry.date.date()
+
+    return entry.tag.upper(), entry.date.date(), entry.description or ''
+
+
+def merge_entries(entries: list[TogglEntry]) -> Optional[TogglEntry]:
+    minutes = round_minutes(sum(entry.minutes for entry in entries))
+
+    if minutes == 0:
+        return None
+
+    descriptions = list(dict.fromkeys(entry.description for entry in entries if entry.description))
+    source_ids = sorted(entry.id for entry in entries if entry.id is not None)
+
+    # the lowest toggl id keeps identifying the merged entry in the sync ledger when entries are added to the day
+    return TogglEntry(
+        source_ids[0] if source_ids else None,
+        entries[0].tag,
+        entries[0].start,
+        entries[0].utc_offset,
+        minutes,
+        COALESCED_DESCRIPTION_SEPARATOR.join(descriptions) if descriptions else None,
+        source_ids
+    )
+
+
+def coalesce_entries(entries, policy: str = COALESCE_POLICY):
+    groups = {}
+    current_day = None
+
+    # entries arrive sorted by start, so all groups of a day are complete once the next day starts
+    for entry in entries:
+        if entry.date.date() != current_day:
+            for group in groups.values():
+                if (merged := merge_entries(group)) is not None:
+                    yield merged
+
+            groups = {}
+            current_day = entry.date.date()
+
+        groups.setdefault(get_coalesce_key(entry, policy), []).append(entry)
+
+    for group in groups.values():
+        if (merged := merge_entries(group)) is not None:
+            yield merged
+
+
+def parse_entries(entries, rounded: bool = True):
+    for entry in entries:
+        try:
+            with run_metrics.stage('tag_parsing'):
+                parsed = parse_entry(entry, rounded)
         except Exception as e:
             print('Error while importing entry: {}'.format(entry))
             raise e
 
+        if parsed is not None:
+            yield parsed
+
+
+def iter_entries(start_date: str, end_date: str, policy: str = COALESCE_POLICY, report: bool = False):
+    if policy not in COALESCE_POLICIES:
+        raise ValueError(f"Unknown coalesce policy '{policy}', expected one of {', '.join(COALESCE_POLICIES)}")
+
+    if report:
+        entries = iter_report_entries(start_date, end_date)
+    else:
+        entries = iter_time_entries(start_date, end_date)
+
+    if policy == 'none':
+        yield from parse_entries(entries)
+    else:
+        yield from coalesce_entries(parse_entries(entries, rounded=False), policy)
 
-    entries.sort(key=lambda x: x['date'])
 
-    with io.open('debug/toggl-parsed.json', 'w') as f:
-        f.write(json.dumps(entries, default=str, ensure_ascii=False))
+def write_entries(entries, path: str = TOGGL_ENTRIES_PATH, append: bool = False) -> int:
+    count = 0
 
-    print('Successfully imported {} entries'.format(len(entries)))
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with io.open(path, 'a' if append else 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(entry.to_line())
+            count += 1
+
+    return count
+
+
+def read_entries(path: str = TOGGL_ENTRIES_PATH):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield TogglEntry.from_line(line)
+
+
+def import_entries(start_date: str, end_date: str, report: bool = False):
+    print('Starting import of entries from toggl between {} and {}'.format(start_date, end_date))
+
+    # windows arrive in chronological order, so entries are written already sorted by date
+    count = write_entries(iter_entries(start_date, end_date, report=report))
+
+    print('Successfully imported {} entries'.format(count))
 
 
 if __name__ == '__main__':
-    import_entries(
-        '2024-04-01',
-        '2024-04-08'
-    )
+    if len(sys.argv) > 3 and sys.argv[1] == 'report':
+        # backfill from the workspace report export, e.g. python toggl.py report 2024-01-01 2025-01-01
+        import_entries(sys.argv[2], sys.argv[3], report=True)
+    else:
+        import_entries(
+            '2024-04-01',
+            '2024-04-08'
+        )